@@ -1,15 +1,63 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from chainlit.utils import mount_chainlit
-from db import users_collection, verify_password
-from services.auth import generate_jwt, register_user
+from db import users_collection
+from services.auth import generate_jwt, register_user, token_cache
+from services.passwords import password_scheduler, verify_password
+from services.scheduler import SchedulerRejected
+from services.quotas import user_limiter
+from services.search import search_offset, search_turns
+from services.singleflight import classifier_flights, llm_flights
+from services.metrics import MetricsMiddleware, register_gauges, render_metrics, span
 from pydantic import BaseModel
-from fastapi.responses import RedirectResponse
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 import os
+import asyncio
 from services.auth import get_user_id_from_request
-from db import users_collection, conversations_collection, usage_metadata_collection
+from db import (
+    users_collection,
+    conversations_collection,
+    usage_daily_collection,
+)
 from bson import ObjectId
 from llm import LLM_LIST
+from services.providers import model_schedulers
+from services.clients import close_clients, warm_up
+from evaluate import classifier_snapshot
+from services.conditional import (
+    is_not_modified,
+    make_etag,
+    not_modified_response,
+    set_validators,
+)
+from services.history import (
+    NOT_DELETED,
+    drain_turn_writes,
+    encode_cursor,
+    flatten_turns,
+    list_conversations,
+    load_turns,
+    remove_conversation,
+    settle_turn_writes,
+)
+from services.schema import SCHEMA_ON_STARTUP, bootstrap_status, start_bootstrap
+from services.usage import (
+    USAGE_EXPORT_TYPES,
+    export_usage_events,
+    list_usage_events,
+    usage_day,
+    usage_fields,
+    usage_recorder,
+)
+from services.history_cache import history_cache
+from services.response_cache import response_cache
+from typing import Optional
 import requests
 from datetime import datetime, timedelta
 
@@ -19,12 +67,39 @@ GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 REDIRECT_CLIENT_GOOGLE = os.getenv("REDIRECT_CLIENT_GOOGLE")
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Last-Cursor", "ETag", "Last-Modified"],
 )
+app.add_middleware(MetricsMiddleware)
+# Negotiated from Accept-Encoding, small bodies are sent as is
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+
+
+# Build the provider clients while the worker starts instead of on the
+# first chat turn
+WARM_ON_STARTUP = os.getenv("WARM_ON_STARTUP", "true").lower() == "true"
+_warm_up_task = None
+
+
+@app.on_event("startup")
+async def startup():
+    global _warm_up_task
+    if SCHEMA_ON_STARTUP:
+        start_bootstrap()
+    if WARM_ON_STARTUP:
+        _warm_up_task = asyncio.create_task(warm_up())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await drain_turn_writes()
+    await usage_recorder.drain()
+    await close_clients()
 
 
 @app.get("/")
@@ -32,6 +107,20 @@ async def root():
     return {"message": "API is running..."}
 
 
+@app.get("/ready")
+async def ready():
+    timings, errors = await warm_up()
+    if SCHEMA_ON_STARTUP:
+        start_bootstrap()
+        schema = bootstrap_status()
+        if schema != "ready":
+            errors["schema"] = schema
+    return JSONResponse(
+        {"ready": not errors, "seconds": timings, "errors": errors},
+        status_code=503 if errors else 200,
+    )
+
+
 class LoginUser(BaseModel):
     email: str
     password: str
@@ -45,12 +134,18 @@ class RegisterUser(BaseModel):
 
 @app.post("/login")
 async def login(user: LoginUser):
-    db_user = users_collection.find_one({"email": user.email})
+    with span("mongo", "users.find_one"):
+        db_user = await users_collection.find_one({"email": user.email})
 
     if not db_user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
-    if verify_password(user.password, db_user["password"]):
+    try:
+        password_ok = await verify_password(user.password, db_user["password"])
+    except SchedulerRejected as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    if password_ok:
         token = generate_jwt(str(db_user["_id"]))
         return {"token": token}
 
@@ -59,7 +154,11 @@ async def login(user: LoginUser):
 
 @app.post("/register")
 async def register(user: RegisterUser):
-    if not register_user(user.email, user.password, user.username):
+    try:
+        registered = await register_user(user.email, user.password, user.username)
+    except SchedulerRejected as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if not registered:
         raise HTTPException(status_code=400, detail="User already exists")
     return {"message": "User registered successfully"}
 
@@ -102,7 +201,8 @@ async def google_callback(code: str):
         if not email:
             return {"error": "Unauthorized"}
 
-        db_user = users_collection.find_one({"email": email})
+        with span("mongo", "users.find_one"):
+            db_user = await users_collection.find_one({"email": email})
         if db_user:
             user_id = str(db_user["_id"])
         else:
@@ -112,7 +212,8 @@ async def google_callback(code: str):
                 "picture": picture,
                 "sub": sub,
             }
-            result = users_collection.insert_one(new_user)
+            with span("mongo", "users.insert_one"):
+                result = await users_collection.insert_one(new_user)
             user_id = str(result.inserted_id)
         jwt_token = generate_jwt(str(user_id))
         return RedirectResponse(
@@ -129,7 +230,8 @@ async def google_callback(code: str):
 async def get_info_user(request: Request):
     try:
         user_id = get_user_id_from_request(request)
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        with span("mongo", "users.find_one"):
+            user = await users_collection.find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         user_info = {
@@ -145,24 +247,48 @@ async def get_info_user(request: Request):
 
 
 @app.get("/conversations")
-async def get_conversations(request: Request):
+async def get_conversations(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+):
     try:
         user_id = get_user_id_from_request(request)
-        conversations = list(conversations_collection.find({"user_id": user_id}))
-        elements = []
-
-        for convo in conversations:
-            messages = convo.get("messages", [])
-            short_content = "No Msg"
+        await settle_turn_writes(user_id)
+        with span("mongo", "list_conversations"):
+            conversations, next_cursor = await list_conversations(
+                user_id, cursor=cursor, limit=limit
+            )
 
-            if messages:
-                first_message_entry = messages[0].get("messages", [])
-                if first_message_entry:
-                    first_message_text = first_message_entry[0].get("text", "")
-                    words = first_message_text.split()
-                    short_content = " ".join(words[:6]) if words else "No Msg"
+        # The page changes when a conversation is added, deleted or gets a turn
+        etag = make_etag(
+            cursor,
+            limit,
+            next_cursor,
+            *(
+                f"{c['_id']}:{c.get('version', 0)}:{c.get('updated_at')}"
+                for c in conversations
+            ),
+        )
+        # No Last-Modified: a deletion doesn't move the newest updated_at, so
+        # If-Modified-Since alone would keep returning 304 for a stale page
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+        set_validators(response, etag)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
 
-            elements.append({"id_conv": str(convo["_id"]), "content": short_content})
+        elements = []
+        for convo in conversations:
+            elements.append(
+                {
+                    "id_conv": str(convo["_id"]),
+                    "content": convo.get("title", "No Msg"),
+                    "preview": convo.get("preview", ""),
+                    "updated_at": convo.get("updated_at"),
+                }
+            )
 
         return elements
     except Exception as e:
@@ -173,47 +299,133 @@ async def get_conversations(request: Request):
 async def delete_conversation(conv_id: str, request: Request):
     try:
         user_id = get_user_id_from_request(request)
-
-        conversation = conversations_collection.find_one(
-            {"_id": ObjectId(conv_id), "user_id": user_id}
-        )
-        if not conversation:
+        if not await remove_conversation(conv_id, user_id):
             raise HTTPException(status_code=404, detail="Conversation not found")
-
-        conversations_collection.delete_one({"_id": ObjectId(conv_id)})
         return {"message": "Conversation deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
 
 
 @app.get("/history/{conv_id}")
-async def get_history(conv_id: str, request: Request):
+async def get_history(
+    conv_id: str,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+):
     try:
         user_id = get_user_id_from_request(request)
-        conversation = conversations_collection.find_one(
-            {"_id": ObjectId(conv_id), "user_id": user_id}
-        )
+        await settle_turn_writes(user_id)
+        with span("mongo", "conversations.find_one"):
+            conversation = await conversations_collection.find_one(
+                {"_id": ObjectId(conv_id), "user_id": user_id, **NOT_DELETED},
+                {"version": 1, "updated_at": 1},
+            )
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
-        return conversation.get("messages", [])
+
+        # Answered from the conversation version alone, turns are only read
+        # when the client's copy is stale
+        etag = make_etag(conv_id, conversation.get("version", 0), cursor, limit)
+        last_modified = conversation.get("updated_at")
+        if is_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+
+        with span("mongo", "load_turns"):
+            turns, next_cursor = await load_turns(conv_id, cursor=cursor, limit=limit)
+        set_validators(response, etag, last_modified)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        # Delta reads: passing this back as cursor returns only newer turns
+        last_cursor = encode_cursor(turns[-1]) if turns else cursor
+        if last_cursor:
+            response.headers["X-Last-Cursor"] = last_cursor
+        return flatten_turns(turns)
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+
+@app.get("/search")
+async def search(
+    q: str,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+):
+    try:
+        user_id = get_user_id_from_request(request)
+        if not q.strip():
+            raise HTTPException(status_code=400, detail="Empty search query")
+        try:
+            search_offset(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # Turns of this user still being written show up in the results
+        await settle_turn_writes(user_id)
+        with span("mongo", "search_turns"):
+            results, next_cursor = await search_turns(
+                user_id, q, cursor=cursor, limit=limit
+            )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return {"query": q, "results": results, "next_cursor": next_cursor}
+    except HTTPException as http_exc:
+        raise http_exc
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
 
 
 @app.get("/usage")
-async def get_usage_metadata(request: Request):
+async def get_usage_metadata(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    fields: Optional[str] = None,
+    export: Optional[str] = None,
+):
     try:
         user_id = get_user_id_from_request(request)
-        usage_data = list(
-            usage_metadata_collection.find({"user_id": user_id}).sort("timestamp", -1)
-        )
-        if not usage_data:
+        fields = [field.strip() for field in fields.split(",")] if fields else None
+        try:
+            usage_fields(fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if export:
+            if export not in USAGE_EXPORT_TYPES:
+                raise HTTPException(
+                    status_code=400, detail=f"Unsupported export format: {export}"
+                )
+            return StreamingResponse(
+                export_usage_events(user_id, export, fields, cursor),
+                media_type=USAGE_EXPORT_TYPES[export],
+                headers={
+                    "Content-Disposition": f'attachment; filename="usage.{export}"'
+                },
+            )
+
+        with span("mongo", "usage_metadata.find"):
+            usage_data, next_cursor = await list_usage_events(
+                user_id, cursor=cursor, limit=limit, fields=fields
+            )
+        if not usage_data and not cursor:
             raise HTTPException(
                 status_code=404, detail="No usage data found for this user"
             )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         for entry in usage_data:
             entry["_id"] = str(entry["_id"])
-        return {"user_id": user_id, "usage_data": usage_data}
+        return {
+            "user_id": user_id,
+            "usage_data": usage_data,
+            "next_cursor": next_cursor,
+        }
+    except HTTPException as http_exc:
+        raise http_exc
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
 
@@ -222,34 +434,21 @@ async def get_usage_metadata(request: Request):
 async def get_total_usage_by_models(request: Request):
     try:
         user_id = get_user_id_from_request(request)
-        models = ["gemini-2.0-flash", "llama3.2:latest"]
+        models = LLM_LIST
 
-        data_usage_model = []
+        pipeline = [
+            {"$match": {"user_id": user_id, "model": {"$in": models}}},
+            {"$group": {"_id": "$model", "total_tokens": {"$sum": "$total_tokens"}}},
+        ]
+        with span("mongo", "usage_daily.aggregate"):
+            totals = {
+                item["_id"]: item["total_tokens"]
+                async for item in await usage_daily_collection.aggregate(pipeline)
+            }
 
+        data_usage_model = []
         for model in models:
-            pipeline = [
-                {
-                    "$match": {"user_id": user_id, "model": model}
-                },  # filter by user_id and model
-                {
-                    "$group": {
-                        "_id": None,
-                        "total_tokens": {
-                            "$sum": {
-                                "$add": [
-                                    "$prompt_token_count",
-                                    "$candidates_token_count",
-                                ]
-                            }
-                        },
-                    }
-                },
-            ]
-
-            result = list(usage_metadata_collection.aggregate(pipeline))
-            total_tokens = result[0]["total_tokens"] if result else 0
-
-            data_usage_model.append({"model": model, "token": total_tokens})
+            data_usage_model.append({"model": model, "token": totals.get(model, 0)})
 
         return data_usage_model
 
@@ -266,19 +465,11 @@ async def get_total_usage(request: Request):
 
         pipeline = [
             {"$match": {"user_id": user_id}},
-            {
-                "$group": {
-                    "_id": None,
-                    "total_tokens": {
-                        "$sum": {
-                            "$add": ["$prompt_token_count", "$candidates_token_count"]
-                        }
-                    },
-                }
-            },
+            {"$group": {"_id": None, "total_tokens": {"$sum": "$total_tokens"}}},
         ]
 
-        result = list(usage_metadata_collection.aggregate(pipeline))
+        with span("mongo", "usage_daily.aggregate"):
+            result = await (await usage_daily_collection.aggregate(pipeline)).to_list()
 
         total_tokens = result[0]["total_tokens"] if result else 0
 
@@ -299,52 +490,35 @@ async def get_weekly_usage_summary(request: Request):
         # last 10 days
         end_date = datetime.utcnow()
         start_date = end_date - timedelta(days=9)
-        # filter data with 2 models
-        pipeline = [
-            {
-                "$match": {
-                    "user_id": user_id,
-                    "model": {"$in": ["gemini-2.0-flash", "llama3.2:latest"]},
-                    "timestamp": {"$gte": start_date, "$lte": end_date},
-                }
-            },
-            {
-                "$group": {
-                    "_id": {
+        # filter data with the registered models
+        with span("mongo", "usage_daily.find"):
+            items = await (
+                usage_daily_collection.find(
+                    {
+                        "user_id": user_id,
+                        "model": {"$in": LLM_LIST},
                         "date": {
-                            "$dateToString": {
-                                "format": "%Y-%m-%d",
-                                "date": "$timestamp",
-                            }
+                            "$gte": usage_day(start_date),
+                            "$lte": usage_day(end_date),
                         },
-                        "model": "$model",
                     },
-                    "total_tokens": {
-                        "$sum": {
-                            "$add": ["$prompt_token_count", "$candidates_token_count"]
-                        }
-                    },
-                }
-            },
-            {"$sort": {"_id.date": 1}},
-        ]
-        result = list(usage_metadata_collection.aggregate(pipeline))
+                    {"_id": 0, "date": 1, "model": 1, "total_tokens": 1},
+                )
+                .sort("date", 1)
+                .to_list()
+            )
         usage_summary = {}
-        for item in result:
-            date = item["_id"]["date"]
+        for item in items:
+            date = item["date"]
             reversed_date = datetime.strptime(date, "%Y-%m-%d").strftime("%d-%m-%Y")
-            model = item["_id"]["model"]
+            model = item["model"]
 
             if reversed_date not in usage_summary:
                 usage_summary[reversed_date] = {
                     "date": reversed_date,
-                    "gemini-2.0-flash": 0,
-                    "llama3.2:latest": 0,
+                    **{model_name: 0 for model_name in LLM_LIST},
                 }
-            if model == "gemini-2.0-flash":
-                usage_summary[reversed_date]["gemini-2.0-flash"] = item["total_tokens"]
-            elif model == "llama3.2:latest":
-                usage_summary[reversed_date]["llama3.2:latest"] = item["total_tokens"]
+            usage_summary[reversed_date][model] = item["total_tokens"]
         usage_summary_list = list(usage_summary.values())
         return {"user_id": user_id, "usage_summary": usage_summary_list}
 
@@ -359,4 +533,78 @@ async def get_llm_list():
     return {"models": LLM_LIST}
 
 
+def collect_gauges():
+    schedulers = {name: s.snapshot() for name, s in model_schedulers.items()}
+    password_pool = password_scheduler.snapshot()
+    responses = response_cache.snapshot()
+    return {
+        "model_scheduler_active": (
+            "Model calls in flight",
+            {(("model", name),): snap["active"] for name, snap in schedulers.items()},
+        ),
+        "model_scheduler_queue_depth": (
+            "Model calls waiting for a slot",
+            {
+                (("model", name),): snap["queue_depth"]
+                for name, snap in schedulers.items()
+            },
+        ),
+        "password_pool_active": (
+            "Password hashes running",
+            {(): password_pool["active"]},
+        ),
+        "password_pool_queue_depth": (
+            "Logins and sign-ups waiting for a hashing thread",
+            {(): password_pool["queue_depth"]},
+        ),
+        "token_cache_entries": (
+            "Verified tokens cached",
+            {(): token_cache.snapshot()["entries"]},
+        ),
+        "classifier_cache_entries": (
+            "Complexity answers cached",
+            {(): classifier_snapshot()["cache_entries"]},
+        ),
+        "usage_recorder_queued": (
+            "Usage events waiting to be written",
+            {(): usage_recorder.snapshot()["queued"]},
+        ),
+        "history_cache_bytes": (
+            "Approximate size of the shared history cache",
+            {(): history_cache.bytes},
+        ),
+        "history_cache_entries": (
+            "Conversations in the shared history cache",
+            {(): history_cache.snapshot()["entries"]},
+        ),
+        "response_cache_entries": (
+            "Cached model responses",
+            {(): responses["entries"]},
+        ),
+        "response_cache_bytes": (
+            "Size of the cached model responses",
+            {(): responses["bytes"]},
+        ),
+        "quota_tracked_users": (
+            "Users with limiter state on this worker",
+            {(): user_limiter.snapshot()["users"]},
+        ),
+        "singleflight_in_flight": (
+            "Shared upstream calls running",
+            {
+                (("name", flights.name),): flights.snapshot()["in_flight"]
+                for flights in (llm_flights, classifier_flights)
+            },
+        ),
+    }
+
+
+register_gauges(collect_gauges)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 mount_chainlit(app=app, target="cl_app.py", path="/chainlit")
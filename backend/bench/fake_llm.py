@@ -0,0 +1,189 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+@dataclass
+class LLMBehaviour:
+    latency: float = 0.2  # seconds before the first token
+    tokens_per_second: float = 200.0
+    output_tokens: int = 120
+    error_rate: float = 0.0
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+    def token_delay(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+
+def fake_tokens(prompt, count):
+    words = prompt.split()[-8:] or ["ok"]
+    return [f"{words[i % len(words)]} " for i in range(count)]
+
+
+def prompt_tokens(text):
+    return max(1, len(text) // 4)
+
+
+# Ollama: a real HTTP server speaking /api/chat, streamed as NDJSON
+
+
+def create_ollama_app(behaviour):
+    async def chat(request):
+        payload = await request.json()
+        prompt = payload["messages"][-1]["content"]
+        await asyncio.sleep(behaviour.latency)
+        if behaviour.fails():
+            return JSONResponse({"error": "fake ollama failure"}, status_code=500)
+
+        tokens = fake_tokens(prompt, behaviour.output_tokens)
+        usage = {
+            "prompt_eval_count": prompt_tokens(prompt),
+            "eval_count": len(tokens),
+        }
+        if not payload.get("stream", True):
+            await asyncio.sleep(behaviour.token_delay() * len(tokens))
+            return JSONResponse(
+                {
+                    "model": payload["model"],
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "done": True,
+                    **usage,
+                }
+            )
+
+        async def lines():
+            for token in tokens:
+                await asyncio.sleep(behaviour.token_delay())
+                message = {"role": "assistant", "content": token}
+                yield json.dumps({"message": message, "done": False}) + "\n"
+            yield json.dumps({"message": {"content": ""}, "done": True, **usage})
+            yield "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    return Starlette(routes=[Route("/api/chat", chat, methods=["POST"])])
+
+
+class FakeOllamaServer:
+    # Runs on its own thread and loop, so the fake's work doesn't show up
+    # in the latencies of the app under test
+    def __init__(self, behaviour, host="127.0.0.1", port=0):
+        config = uvicorn.Config(
+            create_ollama_app(behaviour),
+            host=host,
+            port=port,
+            log_level="warning",
+            lifespan="off",
+        )
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/api/chat"
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+# Gemini: the SDK talks gRPC to Google, so it is replaced at the model
+# object instead, with the same async interface the providers use
+
+
+def gemini_response(text, prompt):
+    return SimpleNamespace(
+        text=text,
+        usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens(prompt),
+            candidates_token_count=prompt_tokens(text),
+        ),
+    )
+
+
+class FakeGeminiStream:
+    def __init__(self, behaviour, prompt):
+        self.behaviour = behaviour
+        self.tokens = fake_tokens(prompt, behaviour.output_tokens)
+        self.usage_metadata = gemini_response(
+            "".join(self.tokens), prompt
+        ).usage_metadata
+
+    async def __aiter__(self):
+        for token in self.tokens:
+            await asyncio.sleep(self.behaviour.token_delay())
+            part = SimpleNamespace(text=token)
+            yield SimpleNamespace(
+                candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))]
+            )
+
+
+class FakeGeminiChat:
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+
+    async def send_message_async(
+        self, content, stream=False, generation_config=None, request_options=None
+    ):
+        await asyncio.sleep(self.behaviour.latency)
+        if self.behaviour.fails():
+            raise RuntimeError("fake gemini failure")
+        if stream:
+            return FakeGeminiStream(self.behaviour, content)
+        tokens = fake_tokens(content, self.behaviour.output_tokens)
+        await asyncio.sleep(self.behaviour.token_delay() * len(tokens))
+        return gemini_response("".join(tokens), content)
+
+
+class FakeGeminiModel:
+    def __init__(self, behaviour, classifier_answer="false"):
+        self.behaviour = behaviour
+        self.classifier_answer = classifier_answer
+
+    def start_chat(self, history=None):
+        return FakeGeminiChat(self.behaviour)
+
+    async def generate_content_async(self, content, request_options=None):
+        # Used by the complexity classifier, which only reads TRUE/FALSE
+        await asyncio.sleep(self.behaviour.latency)
+        if self.behaviour.fails():
+            raise RuntimeError("fake gemini failure")
+        return gemini_response(self.classifier_answer, content)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Ollama /api/chat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--output-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    behaviour = LLMBehaviour(
+        args.latency, args.tokens_per_second, args.output_tokens, args.error_rate
+    )
+    uvicorn.run(create_ollama_app(behaviour), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
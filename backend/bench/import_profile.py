@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Profiles what importing a module costs a fresh interpreter, using
+# python -X importtime. Run from backend/:
+#   python -m bench.import_profile                      # app, top 15 imports
+#   python -m bench.import_profile --output boot.json   # keep as a baseline
+#   python -m bench.import_profile --baseline boot.json
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:   self_us | cumulative_us | <indent>name"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|", 2)
+        # One space after the bar, then two more per nesting level
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        imports.append(
+            {
+                "module": name.strip(),
+                "depth": depth,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            }
+        )
+    return imports
+
+
+def profile(module, env):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{result.stderr[-2000:]}")
+    imports = parse_importtime(result.stderr)
+    # Children are printed before their parent, so the direct dependencies
+    # of the module are the depth 1 lines right above its own line
+    children, pending = [], []
+    import_ms = 0.0
+    for entry in imports:
+        if entry["depth"] == 1:
+            pending.append(entry)
+        elif entry["depth"] == 0:
+            if entry["module"] == module:
+                children, import_ms = pending, entry["cumulative_ms"]
+            pending = []
+    return {
+        "module": module,
+        "wall_ms": wall_ms,
+        "import_ms": import_ms,
+        "dependencies": sorted(
+            children, key=lambda i: i["cumulative_ms"], reverse=True
+        ),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time profile of the app")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=3, help="best of N runs")
+    parser.add_argument("--output", help="write the profile to this JSON file")
+    parser.add_argument("--baseline", help="compare against this profile")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    env = {**os.environ}
+    env.setdefault("GOOGLE_API_KEY", "profile")
+    runs = [profile(args.module, env) for _ in range(args.runs)]
+    report = min(runs, key=lambda r: r["import_ms"])
+
+    print(
+        f"import {report['module']}: {report['import_ms']:.0f} ms "
+        f"(process {report['wall_ms']:.0f} ms, best of {args.runs})"
+    )
+    for i in report["dependencies"][: args.top]:
+        print(f"{i['cumulative_ms']:>10.1f} ms  {i['module']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        before, after = baseline["import_ms"], report["import_ms"]
+        print(f"baseline {before:.0f} ms -> {after:.0f} ms")
+        if after > before * (1 + args.tolerance):
+            print("REGRESSION import time")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
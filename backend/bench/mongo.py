@@ -0,0 +1,127 @@
+import mongomock
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# In-memory stand-in for the async pymongo client, backed by mongomock.
+# Only the parts of the API the app uses are covered: find() returns a
+# cursor right away, everything else is awaited.
+
+
+class FakeCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._iterator = None
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, count):
+        self._cursor = self._cursor.limit(count)
+        return self
+
+    def skip(self, count):
+        self._cursor = self._cursor.skip(count)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def to_list(self, length=None):
+        documents = list(self._cursor)
+        return documents if length is None else documents[:length]
+
+    def __aiter__(self):
+        self._iterator = iter(self._cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        kwargs.pop("batch_size", None)
+        return FakeCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return FakeCursor(self._collection.aggregate(pipeline))
+
+    async def bulk_write(self, requests, ordered=True):
+        # mongomock's bulk_write does not accept the operations of recent
+        # pymongo releases, so they are replayed one by one. Failures are
+        # reported like the server does, as one BulkWriteError.
+        write_errors = []
+        for index, request in enumerate(requests):
+            try:
+                self._apply(request)
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors})
+
+    def _apply(self, request):
+        if isinstance(request, UpdateOne):
+            self._collection.update_one(
+                request._filter, request._doc, upsert=request._upsert
+            )
+        elif isinstance(request, InsertOne):
+            self._collection.insert_one(request._doc)
+        elif isinstance(request, ReplaceOne):
+            self._collection.replace_one(
+                request._filter, request._doc, upsert=request._upsert
+            )
+        else:
+            raise NotImplementedError(type(request).__name__)
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class FakeDatabase:
+    def __init__(self, name="chatbot_db"):
+        self._db = mongomock.MongoClient()[name]
+        self._collections = {}
+
+    async def command(self, *args, **kwargs):
+        return self._db.command(*args, **kwargs)
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self._db[name])
+        return self._collections[name]
+
+
+COLLECTIONS = {
+    "users_collection": "users",
+    "conversations_collection": "conversations",
+    "messages_collection": "messages",
+    "usage_metadata_collection": "usage_metadata",
+    "usage_daily_collection": "usage_daily",
+    "schema_migrations_collection": "schema_migrations",
+}
+
+
+def install_fake_mongo():
+    # Must run before app, cl_app or services are imported, they bind the
+    # collections at import time
+    import db
+
+    fake_db = FakeDatabase()
+    db.db = fake_db
+    for attribute, name in COLLECTIONS.items():
+        setattr(db, attribute, fake_db[name])
+    return fake_db
@@ -0,0 +1,452 @@
+import os
+import sys
+import json
+import time
+import random
+import uuid
+import asyncio
+import argparse
+import contextvars
+from datetime import datetime
+from types import SimpleNamespace
+
+from bench.fake_llm import FakeGeminiModel, FakeOllamaServer
+from bench.scenarios import SCENARIOS
+
+# Settings the app reads at import time, real credentials are never needed
+BENCH_ENV = {
+    "GOOGLE_API_KEY": "bench",
+    "SECRET_KEY": "bench-secret",
+    "OLLAMA_API_URL": "http://127.0.0.1:11434/api/chat",
+    "RESPONSE_CACHE_ENABLED": "false",
+    "STREAM_RESPONSES": "false",
+    "WARM_ON_STARTUP": "false",
+    # Simulated users send far faster than the per-user limits allow
+    "USER_REQUESTS_PER_MINUTE": "0",
+    "USER_TOKENS_PER_WINDOW": "0",
+}
+
+BENCH_PASSWORD = "bench-password"
+
+_session = contextvars.ContextVar("bench_session")
+_turn = contextvars.ContextVar("bench_turn")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        "p50": percentile(samples, 50) * 1000,
+        "p95": percentile(samples, 95) * 1000,
+        "p99": percentile(samples, 99) * 1000,
+        "mean": sum(samples) / len(samples) * 1000 if samples else 0.0,
+        "max": max(samples, default=0.0) * 1000,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.ttfts = []
+        self.routes = {}
+        self.errors = 0
+        self.timeouts = 0
+
+    def add(self, latency, route=None, ttft=None, error=False):
+        self.latencies.append(latency)
+        if route:
+            self.routes.setdefault(route, []).append(latency)
+        if ttft is not None:
+            self.ttfts.append(ttft)
+        if error:
+            self.errors += 1
+
+    def result(self, wall_seconds):
+        result = {
+            "count": len(self.latencies),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "throughput_rps": len(self.latencies) / wall_seconds if wall_seconds else 0,
+            "latency_ms": summarize(self.latencies),
+        }
+        if self.ttfts:
+            result["ttft_ms"] = summarize(self.ttfts)
+        if self.routes:
+            result["routes"] = {
+                route: summarize(samples) for route, samples in self.routes.items()
+            }
+        return result
+
+
+# Chainlit stand-ins: one session dict per simulated user, and messages that
+# note when the first output of a turn reached the "client"
+
+
+class BenchUserSession:
+    def get(self, key, default=None):
+        return _session.get().get(key, default)
+
+    def set(self, key, value):
+        _session.get()[key] = value
+
+
+class BenchMessage:
+    def __init__(self, content=""):
+        self.content = content
+        self.metadata = {}
+
+    def _first_output(self):
+        turn = _turn.get(None)
+        if turn is not None and turn.get("first_output") is None:
+            turn["first_output"] = time.perf_counter()
+
+    async def stream_token(self, token):
+        self._first_output()
+
+    async def send(self):
+        self._first_output()
+        turn = _turn.get(None)
+        if turn is not None and self.metadata.get("message_type") in (
+            "single",
+            "multiple",
+        ):
+            turn["response"] = json.loads(self.content)
+
+
+def install_chainlit_stubs(cl_app):
+    cl_app.cl = SimpleNamespace(user_session=BenchUserSession(), Message=BenchMessage)
+
+
+def install_llm_fakes(scenario, ollama_url):
+    import cl_app
+    from llm import MODEL_REGISTRY
+    from services import clients, providers
+
+    # Also answers the complexity classifier, which uses the same model
+    fake_gemini = FakeGeminiModel(scenario.gemini, scenario.classifier_answer)
+    for spec in MODEL_REGISTRY.values():
+        if spec.provider == "gemini":
+            clients._gemini_models[spec.name] = fake_gemini
+    providers.OLLAMA_API_URL = ollama_url
+    cl_app.FANOUT_GRACE = scenario.fanout_grace
+
+
+async def seed_users(count, conversations=20, turns=10):
+    from bson import ObjectId
+    import db
+    from services.auth import generate_jwt
+    from services.history import append_turn, conversation_summary
+    from services.passwords import hash_password
+    from services.usage import usage_recorder
+
+    hashed = await hash_password(BENCH_PASSWORD)
+    users = []
+    for i in range(count):
+        user_id = ObjectId()
+        email = f"bench-{user_id}@example.com"
+        await db.users_collection.insert_one(
+            {
+                "_id": user_id,
+                "username": f"bench{i}",
+                "email": email,
+                "password": hashed,
+            }
+        )
+        conversation_ids = []
+        for c in range(conversations):
+            now = datetime.utcnow()
+            result = await db.conversations_collection.insert_one(
+                {
+                    "user_id": str(user_id),
+                    "created_at": now,
+                    "updated_at": now,
+                    **conversation_summary(f"Seeded conversation {c}"),
+                }
+            )
+            conversation_ids.append(str(result.inserted_id))
+            for t in range(turns):
+                text = f"Seeded message {t} " * 20
+                await append_turn(
+                    conversation_ids[-1],
+                    str(user_id),
+                    [
+                        {
+                            "role": "user",
+                            "timestamp": now.isoformat(),
+                            "messages": [{"model": "gemini-2.0-flash", "text": text}],
+                        },
+                        {
+                            "role": "assistant",
+                            "timestamp": now.isoformat(),
+                            "messages": [{"model": "gemini-2.0-flash", "text": text}],
+                        },
+                    ],
+                )
+            await usage_recorder.record(str(user_id), 100, 200, "gemini-2.0-flash")
+        users.append(
+            {
+                "user_id": str(user_id),
+                "email": email,
+                "token": generate_jwt(str(user_id)),
+                "conversations": conversation_ids,
+            }
+        )
+    await usage_recorder.drain()
+    return users
+
+
+async def http_request(client, route, user):
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    if route == "login":
+        return await client.post(
+            "/login", json={"email": user["email"], "password": BENCH_PASSWORD}
+        )
+    if route == "conversations":
+        return await client.get("/conversations", headers=headers)
+    if route == "conversations_page":
+        return await client.get("/conversations?limit=20", headers=headers)
+    if route == "history":
+        conversation_id = random.choice(user["conversations"])
+        return await client.get(f"/history/{conversation_id}?limit=50", headers=headers)
+    if route == "usage_total":
+        return await client.get("/usage/total", headers=headers)
+    raise ValueError(f"Unknown route {route!r}")
+
+
+async def run_http_user(client, scenario, user, recorder):
+    for i in range(scenario.iterations):
+        route = scenario.routes[i % len(scenario.routes)]
+        started = time.perf_counter()
+        try:
+            response = await http_request(client, route, user)
+            error = response.status_code >= 400
+        except Exception:
+            error = True
+        recorder.add(time.perf_counter() - started, route, error=error)
+
+
+async def run_chat_user(scenario, user, recorder):
+    import cl_app
+    from services.context import new_context_state
+
+    _session.set(
+        {
+            "metadata": {"user_id": user["user_id"], "role": "user"},
+            "message_history": [],
+            "context_state": new_context_state(),
+        }
+    )
+    for i in range(scenario.iterations):
+        message = SimpleNamespace(
+            id=str(uuid.uuid4()),
+            content=random.choice(scenario.prompts),
+            metadata={
+                "conversation_id": _session.get().get("conversation_id"),
+                "model": scenario.model,
+                "stream": scenario.stream,
+            },
+        )
+        turn = {"first_output": None, "response": []}
+        _turn.set(turn)
+        started = time.perf_counter()
+        error = False
+        try:
+            await cl_app.on_message(message)
+        except Exception:
+            error = True
+        latency = time.perf_counter() - started
+        for entry in turn["response"]:
+            if entry.get("status") == "timeout":
+                recorder.timeouts += 1
+            elif entry["text"].startswith("Error calling"):
+                error = True
+        ttft = turn["first_output"] - started if turn["first_output"] else None
+        recorder.add(latency, ttft=ttft, error=error)
+
+
+async def run_scenario(scenario, client, users):
+    from services.clients import close_clients
+
+    ollama = FakeOllamaServer(scenario.ollama).start()
+    try:
+        # Fresh connection pool against this scenario's fake Ollama
+        await close_clients()
+        install_llm_fakes(scenario, ollama.url)
+        recorder = Recorder()
+        started = time.perf_counter()
+        if scenario.kind == "http":
+            runs = [
+                run_http_user(client, scenario, user, recorder)
+                for user in users[: scenario.users]
+            ]
+        else:
+            runs = [
+                asyncio.create_task(run_chat_user(scenario, user, recorder))
+                for user in users[: scenario.users]
+            ]
+        await asyncio.gather(*runs)
+        return recorder.result(time.perf_counter() - started)
+    finally:
+        await close_clients()
+        ollama.stop()
+
+
+def scaled(scenario, scale):
+    scenario.users = max(1, round(scenario.users * scale))
+    scenario.iterations = max(1, round(scenario.iterations * scale))
+    return scenario
+
+
+async def run(scenarios):
+    import httpx
+    import app
+    import cl_app
+    from services.schema import start_bootstrap
+    from services.usage import usage_recorder
+
+    install_chainlit_stubs(cl_app)
+    await app.startup()
+    # Indexes are in place before any request is measured
+    await start_bootstrap()
+    try:
+        users = await seed_users(max(s.users for s in scenarios))
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            results = {}
+            for scenario in scenarios:
+                print(f"running {scenario.name} ...", file=sys.stderr)
+                results[scenario.name] = await run_scenario(scenario, client, users)
+        await usage_recorder.drain()
+        return results
+    finally:
+        await app.shutdown()
+
+
+def compare(results, baseline, tolerance):
+    # Higher latency or lower throughput than the baseline by more than
+    # the tolerance counts as a regression
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        checks = [
+            (f"latency {pct}", result["latency_ms"][pct], base["latency_ms"][pct])
+            for pct in ("p50", "p95", "p99")
+        ]
+        if "ttft_ms" in result and "ttft_ms" in base:
+            checks.append(
+                ("ttft p95", result["ttft_ms"]["p95"], base["ttft_ms"]["p95"])
+            )
+        for label, value, base_value in checks:
+            if base_value and value > base_value * (1 + tolerance):
+                regressions.append((name, label, base_value, value))
+        throughput, base_throughput = (
+            result["throughput_rps"],
+            base["throughput_rps"],
+        )
+        if base_throughput and throughput < base_throughput * (1 - tolerance):
+            regressions.append((name, "throughput", base_throughput, throughput))
+    return regressions
+
+
+def print_report(results):
+    header = (
+        f"{'scenario':<18}{'count':>7}{'errors':>8}{'rps':>9}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttft p50':>10}{'ttft p95':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        latency = result["latency_ms"]
+        ttft = result.get("ttft_ms", {})
+        print(
+            f"{name:<18}{result['count']:>7}{result['errors']:>8}"
+            f"{result['throughput_rps']:>9.1f}{latency['p50']:>10.1f}"
+            f"{latency['p95']:>10.1f}{latency['p99']:>10.1f}"
+            f"{ttft.get('p50', 0):>10.1f}{ttft.get('p95', 0):>10.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the API routes and the chat flow"
+    )
+    parser.add_argument(
+        "--scenarios",
+        help="comma separated scenario names (default: all)",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiply users and iterations"
+    )
+    parser.add_argument(
+        "--mongo-uri",
+        help="use a real (throwaway) MongoDB instead of the in-memory stand-in",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed slowdown before a metric counts as regressed",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    else:
+        from bench.mongo import install_fake_mongo
+
+        install_fake_mongo()
+    random.seed(args.seed)
+
+    names = args.scenarios.split(",") if args.scenarios else None
+    scenarios = [
+        scaled(scenario, args.scale)
+        for scenario in SCENARIOS
+        if names is None or scenario.name in names
+    ]
+    results = asyncio.run(run(scenarios))
+    print_report(results)
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "created_at": datetime.utcnow().isoformat(),
+                    "scale": args.scale,
+                    "scenarios": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, label, before, after in regressions:
+            print(f"REGRESSION {name} {label}: {before:.1f} -> {after:.1f}")
+        if regressions:
+            return 1
+        print("no regressions against", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+from dataclasses import dataclass, field
+
+from bench.fake_llm import LLMBehaviour
+
+SIMPLE_PROMPTS = [
+    "What is the capital of France?",
+    "Explain how a hash map handles collisions",
+    "Why is the sky blue during the day?",
+    "Summarize the causes of the first world war",
+]
+
+COMPLEX_PROMPTS = [
+    "Brainstorm names for a coffee shop near a university",
+    "Write a poem about autumn in the city",
+    "Give me the pros and cons of remote work",
+    "Suggest some weekend projects for learning Rust",
+]
+
+
+@dataclass
+class Scenario:
+    name: str
+    kind: str  # "http" drives app.py routes, "chat" drives cl_app.on_message
+    users: int
+    iterations: int  # requests (http) or turns (chat) per user
+    model: str = "gemini-2.0-flash"
+    prompts: list = field(default_factory=lambda: SIMPLE_PROMPTS)
+    stream: bool = False
+    gemini: LLMBehaviour = field(default_factory=LLMBehaviour)
+    ollama: LLMBehaviour = field(default_factory=LLMBehaviour)
+    classifier_answer: str = "false"
+    fanout_grace: float = 30.0
+    routes: list = field(default_factory=list)
+
+
+SCENARIOS = [
+    Scenario("login", "http", users=20, iterations=1, routes=["login"]),
+    Scenario(
+        "browse",
+        "http",
+        users=50,
+        iterations=10,
+        routes=["conversations", "conversations_page", "history", "usage_total"],
+    ),
+    Scenario("chat_single", "chat", users=50, iterations=5),
+    Scenario("chat_stream", "chat", users=50, iterations=5, stream=True),
+    Scenario(
+        "chat_fanout",
+        "chat",
+        users=30,
+        iterations=3,
+        prompts=COMPLEX_PROMPTS,
+        stream=True,
+        ollama=LLMBehaviour(latency=0.5, tokens_per_second=60),
+    ),
+    Scenario(
+        "chat_slow_ollama",
+        "chat",
+        users=20,
+        iterations=2,
+        prompts=COMPLEX_PROMPTS,
+        ollama=LLMBehaviour(latency=5.0, tokens_per_second=30),
+        fanout_grace=1.0,
+    ),
+    Scenario(
+        "chat_errors",
+        "chat",
+        users=30,
+        iterations=3,
+        gemini=LLMBehaviour(error_rate=0.2),
+    ),
+]
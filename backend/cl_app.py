@@ -1,84 +1,199 @@
 import os
-import google.generativeai as genai
 import asyncio
-import requests
 from services.auth import verify_jwt
+from services.providers import generate
 import chainlit as cl
-from db import users_collection, conversations_collection, usage_metadata_collection
+from db import users_collection, conversations_collection
 from bson import ObjectId
 import jwt
 from config import INSTRUCTION_PROMPT
 import json
 from datetime import datetime
 from evaluate import is_complex_prompt
+from llm import FANOUT_DEADLINE, FANOUT_GRACE, FANOUT_MODELS, MODEL_REGISTRY
+from services.fanout import gather_until
+from services.metrics import span, turn_trace, turns_total
+from services.quotas import QuotaExceeded, user_limiter
+from services.usage import usage_recorder
+from services.context import build_context, new_context_state, schedule_fold
+from services.history_cache import history_cache
+from services.response_cache import response_cache
+from services.singleflight import flight_key, llm_flights
+from services.history import (
+    flatten_turns,
+    load_turns,
+    make_turn_id,
+    schedule_turn_write,
+    to_model_history,
+)
 
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL")
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
-
+# Part of the response cache key for Gemini calls, the model is keyed apart
 settings = {
-    "model": "gemini-2.0-flash",
     "temperature": 0.7,
     "max_output_tokens": 500,
 }
 newchat = False
-model = genai.GenerativeModel(settings["model"])
+
+# Forward model tokens as they arrive instead of one message per turn.
+# Clients can also opt in per message with metadata {"stream": true}.
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+
+PROVIDER_LABELS = {"gemini": "Gemini", "ollama": "Ollama"}
+
+QUOTA_MESSAGES = {
+    "requests": "You are sending messages too quickly.",
+    "tokens": "You have used your token allowance for now.",
+}
 
 
-def save_usage_metadata(
-    user_id, prompt_token_count, candidates_token_count, selected_model
+async def save_usage_metadata(
+    user_id,
+    prompt_token_count,
+    candidates_token_count,
+    selected_model,
+    cached=False,
+    coalesced=False,
 ):
-    usage_metadata_collection.insert_one(
-        {
-            "user_id": user_id,
-            "timestamp": datetime.utcnow(),
-            "prompt_token_count": prompt_token_count,
-            "candidates_token_count": candidates_token_count,
-            "model": selected_model,
-        }
+    await usage_recorder.record(
+        user_id,
+        prompt_token_count,
+        candidates_token_count,
+        selected_model,
+        cached,
+        coalesced,
     )
 
 
-async def call_gemini(
-    message_history, prompted_message_content, user_id, selected_model
+def new_stream_message(model_name):
+    stream_msg = cl.Message(content="")
+    stream_msg.metadata = {
+        "conversation_id": str(cl.user_session.get("conversation_id")),
+        "model": model_name,
+        "message_type": "stream",
+    }
+    return stream_msg
+
+
+async def finish_stream(stream_msg, text):
+    if stream_msg:
+        stream_msg.content = text
+        await stream_msg.send()
+    return text
+
+
+def timeout_text(model_name, waited):
+    return f"{model_name} did not answer within {waited:.1f}s"
+
+
+async def send_notice(conversation_id, model_name, text, status, **metadata):
+    # Same shape as a normal single answer so clients render it as one
+    response_msg = cl.Message(
+        content=json.dumps(
+            [{"model": model_name, "text": text, "status": status}],
+            ensure_ascii=False,
+            indent=2,
+        )
+    )
+    response_msg.metadata = {
+        "conversation_id": str(conversation_id) if conversation_id else None,
+        "message_type": "single",
+        **metadata,
+    }
+    await response_msg.send()
+
+
+async def reject_turn(conversation_id, model_name, error):
+    text = (
+        f"{QUOTA_MESSAGES[error.reason]} Please try again in {error.retry_after:.0f}s."
+    )
+    await send_notice(
+        conversation_id,
+        model_name,
+        text,
+        "rate_limited",
+        rejected=error.reason,
+        retry_after=round(error.retry_after, 1),
+    )
+
+
+async def complete_with_cache(
+    model_name,
+    generation_settings,
+    history,
+    prompt,
+    user_id,
+    stream_msg,
+    bypass_cache,
+    generate,
 ):
-    try:
-        convo = model.start_chat(history=message_history)
-        response = convo.send_message(prompted_message_content)
-        prompt_token_count = getattr(response.usage_metadata, "prompt_token_count", 0)
-        candidates_token_count = getattr(
-            response.usage_metadata, "candidates_token_count", 0
+    on_token = stream_msg.stream_token if stream_msg else None
+    cache_key = response_cache.key(
+        model_name, generation_settings, history, prompt, bypass=bypass_cache
+    )
+    if cache_key:
+        with span("response_cache", "get"):
+            cached_text = await response_cache.get(cache_key)
+        if cached_text is not None:
+            # Still accounted for, with zero tokens
+            await save_usage_metadata(user_id, 0, 0, model_name, cached=True)
+            if on_token:
+                await on_token(cached_text)
+            return cached_text
+
+    # Identical calls already in flight, from any session, are joined
+    with span("llm", model_name):
+        completion, owner = await llm_flights.do(
+            flight_key(model_name, generation_settings, history, prompt),
+            generate,
+            on_token,
         )
-        save_usage_metadata(
-            user_id, prompt_token_count, candidates_token_count, "gemini-2.0-flash"
+    if not owner:
+        with span("save_usage", model_name):
+            await save_usage_metadata(user_id, 0, 0, completion.model, coalesced=True)
+        return completion.text
+
+    with span("save_usage", model_name):
+        await save_usage_metadata(
+            user_id,
+            completion.prompt_token_count,
+            completion.candidates_token_count,
+            completion.model,
         )
-        return response.text
-    except Exception as e:
-        return f"Error calling Gemini API: {str(e)}"
+    if cache_key:
+        with span("response_cache", "set"):
+            await response_cache.set(cache_key, completion.text)
+    return completion.text
 
 
-async def call_llama(prompted_message_content, user_id):
+async def call_model(
+    spec,
+    history,
+    prompted_message_content,
+    user_id,
+    stream_msg=None,
+    bypass_cache=False,
+    priority=0,
+):
     try:
-        payload = {
-            "model": "llama3.2:latest",
-            "messages": [{"role": "user", "content": prompted_message_content}],
-            "stream": False,
-        }
-        headers = {"Content-Type": "application/json"}
-
-        ollama_response = requests.post(OLLAMA_API_URL, json=payload, headers=headers)
-        ollama_response.raise_for_status()
-        response_json = ollama_response.json()
-        prompt_token_count = response_json.get("prompt_eval_count", 0)
-        candidates_token_count = response_json.get("eval_count", 0)
-        save_usage_metadata(
-            user_id, prompt_token_count, candidates_token_count, payload["model"]
-        )
-        return response_json.get("message", {}).get(
-            "content", "Error: No content returned from Ollama."
+        text = await complete_with_cache(
+            spec.name,
+            settings if spec.provider == "gemini" else {},
+            history,
+            prompted_message_content,
+            user_id,
+            stream_msg,
+            bypass_cache,
+            lambda on_token: generate(
+                spec,
+                history,
+                prompted_message_content,
+                on_token=on_token,
+                priority=priority,
+            ),
         )
     except Exception as e:
-        return f"Error calling Ollama API: {str(e)}"
+        text = f"Error calling {PROVIDER_LABELS[spec.provider]} API: {str(e)}"
+    return await finish_stream(stream_msg, text)
 
 
 @cl.on_chat_start
@@ -90,7 +205,7 @@ async def on_chat_start():
     token = user_env["Authorization"].replace("Bearer ", "")
     try:
         user_id = verify_jwt(token)
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
         if user:
             current_user = cl.User(
                 identifier=user["email"],
@@ -105,10 +220,16 @@ async def on_chat_start():
     if not user:
         return
     cl.user_session.set("message_history", [])
+    cl.user_session.set("context_state", new_context_state())
 
 
 @cl.on_message
 async def on_message(message: cl.Message):
+    with turn_trace(lambda: cl.user_session.get("conversation_id")):
+        await handle_message(message)
+
+
+async def handle_message(message):
     selected_conversation_id = message.metadata.get("conversation_id")
     selected_model = message.metadata.get("model")
     current_conversation_id = cl.user_session.get("conversation_id")
@@ -116,81 +237,164 @@ async def on_message(message: cl.Message):
     metadata = cl.user_session.get("metadata")
     user_id = metadata["user_id"]
 
+    # Refused before anything else runs for the turn
+    try:
+        with span("quota"):
+            await user_limiter.admit(user_id)
+    except QuotaExceeded as e:
+        conversation_id = selected_conversation_id
+        if not conversation_id:
+            # A new chat still gets an id, clients match replies on it.
+            # Nothing is written, a later turn with it starts the chat.
+            conversation_id = str(ObjectId())
+        await reject_turn(conversation_id, selected_model, e)
+        turns_total.inc(type="rejected")
+        return
+
     if selected_conversation_id and selected_conversation_id != current_conversation_id:
+        with span("mongo", "conversations.find_one"):
+            existing_conversation = await conversations_collection.find_one(
+                {"_id": ObjectId(selected_conversation_id)},
+                {"user_id": 1, "summary": 1, "summary_covered": 1, "deleted": 1},
+            )
+        if existing_conversation and (
+            existing_conversation.get("user_id") != user_id
+            or existing_conversation.get("deleted")
+        ):
+            # Someone else's or a deleted conversation: nothing is loaded,
+            # cached or written
+            await send_notice(
+                selected_conversation_id,
+                selected_model,
+                "Conversation not found.",
+                "not_found",
+            )
+            turns_total.inc(type="rejected")
+            return
+
         cl.user_session.set("conversation_id", selected_conversation_id)
-        existing_conversation = conversations_collection.find_one(
-            {"_id": ObjectId(selected_conversation_id)}
-        )
         if existing_conversation:
-            db_messages = existing_conversation["messages"]
-            converted_history = []
-            for msg in db_messages:
-                for sub_msg in msg.get("messages", []):
-                    converted_history.append(
-                        {"role": msg["role"], "parts": [{"text": sub_msg["text"]}]}
-                    )
-            message_history = converted_history
+            message_history = history_cache.get(selected_conversation_id)
+            if message_history is None:
+                with span("mongo", "load_turns"):
+                    turns, _ = await load_turns(selected_conversation_id)
+                message_history = to_model_history(flatten_turns(turns))
+                history_cache.put(selected_conversation_id, message_history)
+            context_state = new_context_state(
+                existing_conversation.get("summary", ""),
+                existing_conversation.get("summary_covered", 0),
+            )
         else:
+            # An id the client generated for a new chat, the first turn
+            # creates the conversation. It is not cached until that turn
+            # is written, which is what proves the id is this user's.
             message_history = []
+            context_state = new_context_state()
         cl.user_session.set("message_history", message_history)
+        cl.user_session.set("context_state", context_state)
 
     if not selected_conversation_id:
-        conversation = {"user_id": user_id, "messages": []}
-        conversation_id = str(
-            conversations_collection.insert_one(conversation).inserted_id
-        )
+        # New chat without a client id: the id is made here and the
+        # conversation is only written together with its first turn
+        conversation_id = str(ObjectId())
         cl.user_session.set("conversation_id", conversation_id)
         message_history = []
+        cl.user_session.set("message_history", message_history)
+        history_cache.put(conversation_id, [])
+        cl.user_session.set("context_state", new_context_state())
 
     current_time = datetime.now().isoformat()
     original_user_message = {"role": "user", "parts": [{"text": message.content}]}
     prompted_message_content = f"{INSTRUCTION_PROMPT}\n{message.content}"
     message_history.append(original_user_message)
 
-    # Check if prompt is complex
-    is_complex = is_complex_prompt(message.content)
+    stream = message.metadata.get("stream", STREAM_RESPONSES)
+    # Per-request opt out of the response cache
+    bypass_cache = bool(message.metadata.get("no_cache"))
+    context_state = cl.user_session.get("context_state") or new_context_state()
+    cl.user_session.set("context_state", context_state)
+
+    def start_model(model_name):
+        spec = MODEL_REGISTRY.get(model_name)
+        if spec is None:
+            return
+        history = []
+        if spec.provider == "gemini":
+            # Send a token-budgeted history, older turns go into the summary
+            history, to_fold = build_context(model_name, message_history, context_state)
+            schedule_fold(
+                cl.user_session.get("conversation_id"),
+                user_id,
+                context_state,
+                to_fold,
+            )
+        stream_msgs[model_name] = new_stream_message(model_name) if stream else None
+        model_tasks[model_name] = asyncio.create_task(
+            call_model(
+                spec,
+                history,
+                prompted_message_content,
+                user_id,
+                stream_msgs[model_name],
+                bypass_cache,
+                # Fan-out calls queue behind users who picked that model
+                0 if model_name == selected_model else 1,
+            )
+        )
 
-    # Initialize response variables
-    gemini_response_text = ""
-    llama_response_text = ""
+    # Start the selected model right away and check complexity alongside it,
+    # the other models are only launched for complex prompts
+    loop = asyncio.get_running_loop()
+    turn_started = loop.time()
+    model_tasks = {}
+    stream_msgs = {}
+    start_model(selected_model)
+    try:
+        with span("classify"):
+            is_complex = await is_complex_prompt(message.content)
+        if is_complex:
+            for model_name in FANOUT_MODELS:
+                if model_name not in model_tasks:
+                    start_model(model_name)
+    except BaseException:
+        for task in model_tasks.values():
+            task.cancel()
+        raise
 
+    # A complex turn answers with whatever is ready by the deadline
+    deadline = None
     if is_complex:
-        # Call both models concurrently
-        gemini_task = asyncio.create_task(
-            call_gemini(
-                message_history, prompted_message_content, user_id, selected_model
-            )
+        deadline = FANOUT_DEADLINE - (loop.time() - turn_started)
+    with span("models"):
+        responses, timed_out = await gather_until(
+            model_tasks, deadline, FANOUT_GRACE if is_complex else None
         )
-        llama_task = asyncio.create_task(call_llama(prompted_message_content, user_id))
-        gemini_response_text, llama_response_text = await asyncio.gather(
-            gemini_task, llama_task
+    waited = loop.time() - turn_started
+    for model_name in timed_out:
+        responses[model_name] = None
+        await finish_stream(
+            stream_msgs.get(model_name), timeout_text(model_name, waited)
         )
 
-    else:
-        # Call only the selected model
-        if selected_model == "gemini-2.0-flash":
-            gemini_response_text = await call_gemini(
-                message_history, prompted_message_content, user_id, selected_model
+    # Prepare response message in required format, streamed turns still end
+    # with it so clients get the combined result
+    response_content = []
+    assistant_messages = []
+    for model_name in MODEL_REGISTRY:
+        if model_name not in responses:
+            continue
+        text = responses[model_name]
+        if text is None:
+            response_content.append(
+                {
+                    "model": model_name,
+                    "text": timeout_text(model_name, waited),
+                    "status": "timeout",
+                }
             )
-        elif selected_model == "llama3.2:latest":
-            llama_response_text = await call_llama(prompted_message_content, user_id)
-
-    # Prepare response message in required format
-    response_content = [
-        (
-            {"model": "gemini-2.0-flash", "text": gemini_response_text}
-            if gemini_response_text
-            else None
-        ),
-        (
-            {"model": "llama3.2:latest", "text": llama_response_text}
-            if llama_response_text
-            else None
-        ),
-    ]
-    response_content = [
-        entry for entry in response_content if entry
-    ]  # Remove None entries
+        elif text:
+            response_content.append({"model": model_name, "text": text})
+            assistant_messages.append({"model": model_name, "text": text})
 
     response_msg = cl.Message(
         content=json.dumps(response_content, ensure_ascii=False, indent=2)
@@ -199,52 +403,39 @@ async def on_message(message: cl.Message):
         "conversation_id": str(cl.user_session.get("conversation_id")),
         "message_type": "multiple" if is_complex else "single",
     }
-    await response_msg.send()
+    with span("respond"):
+        await response_msg.send()
+    turns_total.inc(type=response_msg.metadata["message_type"])
 
-    # Store responses in message history
-    if gemini_response_text:
+    # Store responses in message history, timed out models are left out
+    for entry in assistant_messages:
         message_history.append(
-            {"role": "assistant", "parts": [{"text": gemini_response_text}]}
-        )
-    if llama_response_text:
-        message_history.append(
-            {"role": "assistant", "parts": [{"text": llama_response_text}]}
+            {"role": "assistant", "parts": [{"text": entry["text"]}]}
         )
 
-    # Store user message in the database in the new format
-    conversations_collection.update_one(
-        {"_id": ObjectId(cl.user_session.get("conversation_id"))},
+    # Store the user message and the assistant responses as one turn
+    entries = [
         {
-            "$push": {
-                "messages": {
-                    "role": "user",
-                    "timestamp": current_time,
-                    "messages": [{"model": selected_model, "text": message.content}],
-                }
-            }
-        },
-    )
-
-    # Prepare assistant responses
-    assistant_messages = []
-    for model, text in [
-        ("gemini-2.0-flash", gemini_response_text),
-        ("llama3.2:latest", llama_response_text),
-    ]:
-        if text:
-            assistant_messages.append({"model": model, "text": text})
-
-    # Store assistant response in the new format
+            "role": "user",
+            "timestamp": current_time,
+            "messages": [{"model": selected_model, "text": message.content}],
+        }
+    ]
     if assistant_messages:
-        conversations_collection.update_one(
-            {"_id": ObjectId(cl.user_session.get("conversation_id"))},
+        entries.append(
             {
-                "$push": {
-                    "messages": {
-                        "role": "assistant",
-                        "timestamp": current_time,
-                        "messages": assistant_messages,
-                    }
-                }
-            },
+                "role": "assistant",
+                "timestamp": current_time,
+                "messages": assistant_messages,
+            }
         )
+    # Written in the background, the reply has already gone out. The shared
+    # history cache is only extended once the write has succeeded.
+    conversation_id = cl.user_session.get("conversation_id")
+    schedule_turn_write(
+        conversation_id,
+        user_id,
+        entries,
+        datetime.utcnow(),
+        make_turn_id(conversation_id, message.id),
+    )
@@ -1,14 +1,33 @@
-from pymongo import MongoClient
-import os
 import bcrypt
+from services.clients import get_database
+
+
+# Collections resolve the client on first use, so importing db is free and
+# the connection pool is only created once something talks to MongoDB
+class LazyDatabase:
+    def __getitem__(self, name):
+        return get_database()[name]
+
+    def __getattr__(self, name):
+        return getattr(get_database(), name)
+
+
+class LazyCollection:
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_database()[self.name], attr)
+
+
+db = LazyDatabase()
+users_collection = LazyCollection("users")
+conversations_collection = LazyCollection("conversations")
+messages_collection = LazyCollection("messages")
+usage_metadata_collection = LazyCollection("usage_metadata")
+usage_daily_collection = LazyCollection("usage_daily")
+schema_migrations_collection = LazyCollection("schema_migrations")
 
-MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
-db = client["chatbot_db"]
-users_collection = db["users"]
-conversations_collection = db["conversations"]
-messages_collection = db["messages"]
-usage_metadata_collection = db["usage_metadata"]
 
 def hash_password(password):
     salt = bcrypt.gensalt()
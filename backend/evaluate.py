@@ -1,35 +1,165 @@
 import os
-import google.generativeai as genai
+import re
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from llm import CLASSIFIER_MODEL
+from services.clients import get_gemini_model
+from services.metrics import Counter, Histogram
+from services.singleflight import classifier_flights
 
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
 settings = {
-    "model": "gemini-2.0-flash",
+    "model": CLASSIFIER_MODEL,
     "temperature": 0.1,
     "max_output_tokens": 10,
 }
 
-model = genai.GenerativeModel(settings["model"])
+CLASSIFIER_CACHE_SIZE = int(os.getenv("CLASSIFIER_CACHE_SIZE", "2048"))
+CLASSIFIER_CACHE_TTL = float(os.getenv("CLASSIFIER_CACHE_TTL", "3600"))
+CLASSIFIER_TIMEOUT = float(os.getenv("CLASSIFIER_TIMEOUT", "10"))
+
+# Prompts that explicitly ask for several answers, styles or viewpoints
+MULTIPLE_ANSWER_PATTERNS = [
+    re.compile(p)
+    for p in [
+        r"\b(two|2|three|3|several|multiple|different|alternative|various)\s+"
+        r"(ways|answers|versions|approaches|perspectives|options|styles|methods|solutions)\b",
+        r"\b(respond|answer|explain|write|reply)\b.*\b(two|2)\s+(ways|styles|tones)\b",
+        r"\bpros and cons\b",
+        r"\bbrainstorm\b",
+        r"\b(write|compose|create)\s+(a|an|me a|me an)?\s*"
+        r"(poem|story|song|essay|slogan|joke|haiku|tagline)\b",
+        r"\bsuggest\s+(some|a few|several)\b",
+    ]
+]
+
+# Prompts with a single obvious answer or no real question at all
+SINGLE_ANSWER_PATTERNS = [
+    re.compile(p)
+    for p in [
+        r"^[\d\s\.\,\+\-\*/x\^%\(\)=\?]+$",
+        r"^(hi|hello|hey|thanks|thank you|ok|okay|bye|goodbye|good (morning|night))\b[\s\!\.\?]*$",
+        r"^(what|how much) is\s+[\d\s\.\,\+\-\*/x\^%\(\)]+\??$",
+        r"^(translate|convert)\b",
+    ]
+]
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_cache = TTLCache(CLASSIFIER_CACHE_SIZE, CLASSIFIER_CACHE_TTL)
+classifier_answers = Counter(
+    "classifier_answers_total", "Complexity checks by the tier that answered them"
+)
+classifier_llm_seconds = Histogram(
+    "classifier_llm_seconds", "Complexity checks that went to the LLM"
+)
+
+
+def normalize_prompt(user_prompt):
+    return " ".join(user_prompt.lower().split())
+
+
+def prompt_key(user_prompt):
+    return hashlib.sha256(normalize_prompt(user_prompt).encode("utf-8")).hexdigest()
+
+
+def heuristic_is_complex(user_prompt):
+    # True/False when the prompt is obvious, None when the LLM has to decide
+    normalized = normalize_prompt(user_prompt)
+    if not normalized:
+        return False
+    if any(p.search(normalized) for p in MULTIPLE_ANSWER_PATTERNS):
+        return True
+    if any(p.search(normalized) for p in SINGLE_ANSWER_PATTERNS):
+        return False
+    if len(normalized.split()) <= 2:
+        return False
+    return None
 
 
-def is_complex_prompt(user_prompt):
+async def llm_is_complex(user_prompt):
     system_prompt = "You are an AI that evaluates prompt complexity."
     evaluation_prompt = (
-        """Analyze the following prompt and determine if it requires multiple answers, 
+        """Analyze the following prompt and determine if it requires multiple answers,
         has multiple valid interpretations, or can be approached in different ways.
         Consider whether it allows for stylistic choices, different levels of detail,
-        or varying perspectives. Respond with TRUE if multiple distinct answers are 
-        valid or the user asks you to respond in two ways, and FALSE if only one clear 
-        answer exists. Do not provide any explanation. Only return TRUE or FALSE. 
+        or varying perspectives. Respond with TRUE if multiple distinct answers are
+        valid or the user asks you to respond in two ways, and FALSE if only one clear
+        answer exists. Do not provide any explanation. Only return TRUE or FALSE.
         Here is the prompt:\n\n"""
         + user_prompt
     )
 
-    try:
-        response = model.generate_content(evaluation_prompt)
-        content = response.text.strip().lower()
+    response = await asyncio.wait_for(
+        get_gemini_model(settings["model"]).generate_content_async(
+            evaluation_prompt, request_options={"timeout": CLASSIFIER_TIMEOUT}
+        ),
+        CLASSIFIER_TIMEOUT,
+    )
+    content = response.text.strip().lower()
+
+    return content == "true"
+
 
-        return content == "true"
+async def is_complex_prompt(user_prompt):
+    key = prompt_key(user_prompt)
+
+    cached = _cache.get(key)
+    if cached is not None:
+        classifier_answers.inc(tier="cache")
+        return cached
+
+    result = heuristic_is_complex(user_prompt)
+    if result is not None:
+        classifier_answers.inc(tier="heuristic")
+        _cache.set(key, result)
+        return result
+
+    started = time.perf_counter()
+    try:
+        # Sessions sending the same prompt at once share one classifier call
+        result, owner = await classifier_flights.do(
+            key, lambda _: llm_is_complex(user_prompt)
+        )
+        classifier_answers.inc(tier="llm" if owner else "llm_coalesced")
     except Exception:
+        # Not cached, the next identical prompt gets another chance
+        classifier_answers.inc(tier="llm_error")
         return False
+    finally:
+        classifier_llm_seconds.observe(time.perf_counter() - started)
+
+    _cache.set(key, result)
+    return result
+
+
+def classifier_snapshot():
+    return {"cache_entries": len(_cache)}
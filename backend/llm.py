@@ -1,16 +1,54 @@
-LLM_LIST = [
-    "gemini-2.0-flash",
-    "llama3.2:latest",
-    # "bakllava:latest",
-    # "deepsseek-r1:8b",
-    # "llama2:latest",
-    # "llama3-groq-tool-use:8b",
-    # "llama3:latest",
-    # "llama3.1:latest",
-    # "llama3.2-vision:latest",
-    # "llava:13b",
-    # "llava:latest",
-    # "mistral:latest",
-    # "moondream:latest",
-    # "nomic-embed-text:latest"
-]
+import os
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    name: str
+    provider: str  # "gemini" or "ollama"
+    timeout: float  # seconds for one completion, queueing excluded
+    max_concurrency: int  # calls in flight per worker
+    context_tokens: int  # history budget sent with each call
+    fanout: bool = True  # answers complex prompts alongside the selected model
+
+
+# Every model the app can call is declared here, once
+MODEL_REGISTRY = {
+    spec.name: spec
+    for spec in [
+        ModelSpec(
+            name="gemini-2.0-flash",
+            provider="gemini",
+            timeout=float(os.getenv("GEMINI_TIMEOUT", "60")),
+            max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "64")),
+            context_tokens=int(os.getenv("GEMINI_CONTEXT_TOKENS", "8000")),
+        ),
+        ModelSpec(
+            name="llama3.2:latest",
+            provider="ollama",
+            timeout=float(os.getenv("OLLAMA_TIMEOUT", "120")),
+            max_concurrency=int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2")),
+            context_tokens=int(os.getenv("LLAMA_CONTEXT_TOKENS", "4000")),
+        ),
+        # Other local models can be enabled the same way:
+        # "bakllava:latest", "deepsseek-r1:8b", "llama2:latest",
+        # "llama3-groq-tool-use:8b", "llama3:latest", "llama3.1:latest",
+        # "llama3.2-vision:latest", "llava:13b", "llava:latest",
+        # "mistral:latest", "moondream:latest"
+    ]
+}
+
+LLM_LIST = list(MODEL_REGISTRY)
+
+# Background calls (conversation summaries, the complexity check) go to the
+# first Gemini model declared above
+SUMMARY_MODEL = CLASSIFIER_MODEL = next(
+    spec.name for spec in MODEL_REGISTRY.values() if spec.provider == "gemini"
+)
+
+FANOUT_MODELS = [spec.name for spec in MODEL_REGISTRY.values() if spec.fanout]
+
+# Overall budget for a complex prompt, counted from the start of the turn
+FANOUT_DEADLINE = float(os.getenv("FANOUT_DEADLINE", "90"))
+# Once one model has answered, wait at most this long for the others
+FANOUT_GRACE = float(os.getenv("FANOUT_GRACE", "30"))
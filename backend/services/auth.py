@@ -1,20 +1,70 @@
 from http.client import HTTPException
-import bcrypt
+import time
+from collections import OrderedDict
 from db import users_collection
+from services.passwords import hash_password
+from services.metrics import Counter
+from pymongo.errors import DuplicateKeyError
 import os
 import jwt
 from datetime import datetime, timedelta
 from fastapi import Request
-def register_user(email, password, username):
-    if users_collection.find_one({"email": email}):
+async def register_user(email, password, username):
+    if await users_collection.find_one({"email": email}, {"_id": 1}):
         return False
 
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    users_collection.insert_one({"username": username,"email":email, "password": hashed})
+    hashed = await hash_password(password)
+    try:
+        await users_collection.insert_one({"username": username,"email":email, "password": hashed})
+    except DuplicateKeyError:
+        return False
     return True
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "4096"))
+JWT_CACHE_TTL = float(os.getenv("JWT_CACHE_TTL", "300"))
+
+token_cache_lookups = Counter(
+    "token_cache_lookups_total", "Verified-token cache lookups by result"
+)
+
+
+# Claims of tokens that already passed verification, so every request
+# doesn't re-check the signature. Entries never outlive the token's exp.
+class TokenCache:
+    def __init__(self, maxsize=JWT_CACHE_SIZE, ttl=JWT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, token):
+        entry = self._data.get(token)
+        if entry is not None:
+            user_id, expires_at = entry
+            if expires_at > time.time():
+                self._data.move_to_end(token)
+                token_cache_lookups.inc(result="hit")
+                return user_id
+            del self._data[token]
+        token_cache_lookups.inc(result="miss")
+        return None
+
+    def set(self, token, user_id, exp=None):
+        expires_at = time.time() + self.ttl
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+        self._data[token] = (user_id, expires_at)
+        self._data.move_to_end(token)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def snapshot(self):
+        return {"entries": len(self._data)}
+
+
+token_cache = TokenCache()
+
 def generate_jwt(user_id):
     expiration = datetime.utcnow() + timedelta(days=1)
     payload = {"user_id": str(user_id), "exp": expiration}
@@ -22,8 +72,12 @@ def generate_jwt(user_id):
     return token
 
 def verify_jwt(token):
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        token_cache.set(token, payload["user_id"], payload.get("exp"))
         return payload["user_id"]
     except jwt.ExpiredSignatureError:
         return None
@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import importlib
+
+import httpx
+from pymongo import AsyncMongoClient
+from llm import MODEL_REGISTRY
+
+# Every external client of the worker is built here, on first use. Importing
+# the app stays cheap and each client is created once per process.
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "chatbot_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")
+)
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000"))
+
+# Keep-alive pool shared by every session of the worker
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+OLLAMA_MAX_KEEPALIVE = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "16"))
+
+_genai = None
+_gemini_models = {}
+_mongo_client = None
+_http_client = None
+
+
+def get_genai():
+    # google.generativeai pulls in grpc and protobuf, so it is only
+    # imported once a Gemini model is actually needed
+    global _genai
+    if _genai is None:
+        genai = importlib.import_module("google.generativeai")
+        genai.configure(api_key=GOOGLE_API_KEY)
+        _genai = genai
+    return _genai
+
+
+def get_gemini_model(model_name):
+    if model_name not in _gemini_models:
+        _gemini_models[model_name] = get_genai().GenerativeModel(model_name)
+    return _gemini_models[model_name]
+
+
+def get_mongo_client():
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = AsyncMongoClient(
+            MONGO_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        )
+    return _mongo_client
+
+
+def get_database():
+    return get_mongo_client()[MONGO_DB_NAME]
+
+
+def get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        timeout = max(
+            (s.timeout for s in MODEL_REGISTRY.values() if s.provider == "ollama"),
+            default=120.0,
+        )
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+                keepalive_expiry=30.0,
+            ),
+            headers={"Content-Type": "application/json"},
+        )
+    return _http_client
+
+
+async def close_clients():
+    global _http_client, _mongo_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if _mongo_client is not None:
+        await _mongo_client.close()
+        _mongo_client = None
+
+
+async def warm_up():
+    # Builds every client and checks that MongoDB answers. Returns the
+    # seconds each step took and the errors of the steps that failed.
+    def build_gemini_models():
+        for spec in MODEL_REGISTRY.values():
+            if spec.provider == "gemini":
+                get_gemini_model(spec.name)
+
+    async def gemini():
+        # The SDK import is blocking, keep it off the event loop
+        await asyncio.to_thread(build_gemini_models)
+
+    async def http():
+        get_http_client()
+
+    async def mongo():
+        import db
+
+        await db.db.command("ping")
+
+    timings, errors = {}, {}
+    for step, work in [("gemini", gemini), ("http", http), ("mongo", mongo)]:
+        started = time.perf_counter()
+        try:
+            await work()
+            timings[step] = round(time.perf_counter() - started, 4)
+        except Exception as e:
+            errors[step] = str(e)
+    return timings, errors
@@ -0,0 +1,60 @@
+import hashlib
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Response
+
+# Validators for GET routes whose body only changes when a conversation
+# does. Clients (the browser cache included) send them back and get an
+# empty 304 while nothing changed. ETags are weak because GZipMiddleware
+# may re-encode the body.
+
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts):
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8"))
+    return f'W/"{digest.hexdigest()[:20]}"'
+
+
+def http_date(value):
+    # Stored datetimes are naive UTC
+    return format_datetime(value.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+def etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    # Weak comparison, W/ prefixes are ignored on both sides
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def is_not_modified(request, etag, last_modified=None):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have whole seconds
+        modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+        return modified <= since
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    if last_modified:
+        response.headers["Last-Modified"] = http_date(last_modified)
+
+
+def not_modified_response(etag, last_modified=None):
+    response = Response(status_code=304)
+    set_validators(response, etag, last_modified)
+    return response
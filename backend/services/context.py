@@ -0,0 +1,146 @@
+import os
+import asyncio
+import logging
+from bson import ObjectId
+from db import conversations_collection
+from services.history import NOT_DELETED
+from llm import MODEL_REGISTRY, SUMMARY_MODEL
+from services.providers import generate
+from services.quotas import user_limiter
+from services.usage import usage_recorder
+
+logger = logging.getLogger(__name__)
+
+# Prompt tokens allowed for the history sent with each call, per model
+CONTEXT_TOKEN_BUDGETS = {
+    spec.name: spec.context_tokens for spec in MODEL_REGISTRY.values()
+}
+# Share of the budget kept verbatim once older turns have to be folded,
+# so the summary is not rewritten on every turn
+CONTEXT_KEEP_RATIO = float(os.getenv("CONTEXT_KEEP_RATIO", "0.6"))
+# Upper bound for the running summary, which is sent on top of the kept
+# messages. Folds are asked for no more; longer stored summaries are cut
+# when sent and shortened by their next fold.
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "800"))
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and an AI assistant.
+Keep every fact, decision, constraint and open question needed to continue the conversation.
+Be concise, stay under {max_words} words and do not add anything that was not said.
+
+Current summary:
+{summary}
+
+New messages to fold in:
+{transcript}
+
+Updated summary:"""
+
+_fold_tasks = set()
+
+
+def new_context_state(summary="", covered=0):
+    # covered: how many leading history messages the summary replaces
+    return {"summary": summary, "covered": covered, "folding": False}
+
+
+def count_tokens(text):
+    # ~4 characters per token, close enough for budgeting
+    return max(1, (len(text) + 3) // 4)
+
+
+def message_tokens(message):
+    return sum(count_tokens(part.get("text", "")) for part in message["parts"])
+
+
+def summary_message(summary):
+    return {
+        "role": "user",
+        "parts": [
+            {
+                "text": "Summary of the earlier conversation:\n"
+                + summary[: SUMMARY_MAX_TOKENS * 4]
+            }
+        ],
+    }
+
+
+def build_context(model_name, history, state):
+    # Returns the history to send and the messages that should be folded
+    # into the summary. The newest message is always kept, and messages to
+    # fold are still sent until a summary covers them.
+    budget = CONTEXT_TOKEN_BUDGETS.get(model_name)
+    tail = history[state["covered"] :]
+    prefix = [summary_message(state["summary"])] if state["summary"] else []
+
+    prefix_tokens = sum(message_tokens(m) for m in prefix)
+    tail_tokens = [message_tokens(m) for m in tail]
+    if budget is None or prefix_tokens + sum(tail_tokens) <= budget:
+        return prefix + tail, []
+
+    keep_budget = max(budget * CONTEXT_KEEP_RATIO - prefix_tokens, 0)
+    kept_from = len(tail)
+    total = 0
+    for i in range(len(tail) - 1, -1, -1):
+        if total + tail_tokens[i] > keep_budget and kept_from < len(tail):
+            break
+        total += tail_tokens[i]
+        kept_from = i
+    return prefix + tail, tail[:kept_from]
+
+
+async def fold_into_summary(conversation_id, user_id, state, messages):
+    transcript = "\n".join(
+        f"{message['role']}: {part.get('text', '')}"
+        for message in messages
+        for part in message["parts"]
+    )
+    prompt = SUMMARY_PROMPT.format(
+        summary=state["summary"] or "(empty)",
+        transcript=transcript,
+        # ~0.75 words per token
+        max_words=SUMMARY_MAX_TOKENS * 3 // 4,
+    )
+    try:
+        if not user_limiter.within_token_limit(user_id):
+            return
+        # Queued like any other call, behind the turns users are waiting on
+        completion = await generate(
+            MODEL_REGISTRY[SUMMARY_MODEL],
+            [],
+            prompt,
+            priority=1,
+            max_output_tokens=SUMMARY_MAX_TOKENS,
+        )
+        await usage_recorder.record(
+            user_id,
+            completion.prompt_token_count,
+            completion.candidates_token_count,
+            completion.model,
+        )
+        state["summary"] = completion.text.strip()
+        state["covered"] += len(messages)
+        await conversations_collection.update_one(
+            {"_id": ObjectId(conversation_id), **NOT_DELETED},
+            {
+                "$set": {
+                    "summary": state["summary"],
+                    "summary_covered": state["covered"],
+                }
+            },
+        )
+    except Exception:
+        logger.exception("Could not summarize conversation %s", conversation_id)
+    finally:
+        state["folding"] = False
+
+
+def schedule_fold(conversation_id, user_id, state, messages):
+    # Summarizing runs off the response path, one fold per session at a time
+    if not messages or state["folding"]:
+        return
+    state["folding"] = True
+    task = asyncio.create_task(
+        fold_into_summary(conversation_id, user_id, state, messages)
+    )
+    _fold_tasks.add(task)
+    task.add_done_callback(_fold_tasks.discard)
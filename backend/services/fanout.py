@@ -0,0 +1,43 @@
+import asyncio
+
+
+# Waits for the model tasks until the overall deadline (seconds from now,
+# None for no deadline). Once the first task finishes, the others get at
+# most `grace` more seconds. Whatever is still running is cancelled and
+# reported as timed out, so one slow backend can't hold the reply back.
+async def gather_until(tasks, deadline=None, grace=None):
+    loop = asyncio.get_running_loop()
+    deadline_at = loop.time() + deadline if deadline is not None else None
+    pending = set(tasks.values())
+    try:
+        while pending:
+            timeout = None
+            if deadline_at is not None:
+                timeout = deadline_at - loop.time()
+                if timeout <= 0:
+                    break
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                break
+            if grace is not None:
+                grace_at = loop.time() + grace
+                deadline_at = min(deadline_at or grace_at, grace_at)
+                grace = None
+    except BaseException:
+        pending = set(tasks.values())
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    results, timed_out = {}, []
+    for name, task in tasks.items():
+        if task in pending:
+            timed_out.append(name)
+        else:
+            results[name] = task.result()
+    return results, timed_out
@@ -0,0 +1,369 @@
+import os
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from db import conversations_collection, messages_collection
+from services.history_cache import history_cache
+from services.metrics import span
+
+logger = logging.getLogger(__name__)
+
+# One document per chat turn in messages_collection:
+#   {"conversation_id", "user_id", "created_at", "entries": [...]}
+# where entries keep the old embedded format {"role", "timestamp", "messages"}.
+# Conversations carry a denormalized title/preview/updated_at for the sidebar
+# and a version bumped for every turn written to them. Deleting one leaves
+# a {"deleted": true} tombstone, so a turn write still in flight can't
+# upsert it back.
+
+TITLE_WORDS = 6
+PREVIEW_CHARS = 200
+
+TURN_WRITE_RETRIES = int(os.getenv("TURN_WRITE_RETRIES", "4"))
+# How long history reads wait for a user's turns still being written
+TURN_WRITE_SETTLE_TIMEOUT = float(os.getenv("TURN_WRITE_SETTLE_TIMEOUT", "2"))
+
+_turn_writes = {}
+
+NOT_DELETED = {"deleted": {"$ne": True}}
+
+
+def encode_cursor(doc, field="created_at"):
+    return f"{doc[field].isoformat()}|{doc['_id']}"
+
+
+def decode_cursor(cursor):
+    created_at, turn_id = cursor.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), ObjectId(turn_id)
+
+
+def conversation_summary(text):
+    words = text.split()
+    return {
+        "title": " ".join(words[:TITLE_WORDS]) if words else "No Msg",
+        "preview": text[:PREVIEW_CHARS],
+    }
+
+
+def entries_text(entries):
+    if not entries or not entries[0].get("messages"):
+        return ""
+    return entries[0]["messages"][0].get("text", "")
+
+
+def make_turn_id(conversation_id, message_id):
+    # Same conversation and message always map to the same _id, so writing
+    # a turn twice (retries, a re-delivered message) can't duplicate it
+    digest = hashlib.sha256(f"{conversation_id}:{message_id}".encode("utf-8"))
+    return ObjectId(digest.digest()[:12])
+
+
+async def append_turn(conversation_id, user_id, entries, created_at=None, turn_id=None):
+    turn = {
+        "_id": turn_id or ObjectId(),
+        "conversation_id": str(conversation_id),
+        "user_id": user_id,
+        "created_at": created_at or datetime.utcnow(),
+        "entries": entries,
+    }
+
+    # The conversation is created by its first turn. Title and preview come
+    # from that turn only, later turns just bump recency. It is written
+    # before the turn so a turn never lands under someone else's id.
+    summary = conversation_summary(entries_text(entries))
+    with span("mongo", "conversations.update_one"):
+        await conversations_collection.update_one(
+            {"_id": ObjectId(conversation_id), "user_id": user_id, **NOT_DELETED},
+            [
+                {
+                    "$set": {
+                        "created_at": {"$ifNull": ["$created_at", turn["created_at"]]},
+                        "updated_at": {"$max": ["$updated_at", turn["created_at"]]},
+                        "title": {
+                            "$ifNull": ["$title", {"$literal": summary["title"]}]
+                        },
+                        "preview": {
+                            "$ifNull": ["$preview", {"$literal": summary["preview"]}]
+                        },
+                    }
+                }
+            ],
+            upsert=True,
+        )
+
+    with span("mongo", "messages.insert_one"):
+        try:
+            await messages_collection.insert_one(turn)
+        except DuplicateKeyError:
+            pass  # already written by an earlier attempt
+
+    # Bumped once the turn is readable, /history derives its ETag from it.
+    # A retry may bump it twice, which only costs clients one refetch.
+    with span("mongo", "conversations.update_one"):
+        result = await conversations_collection.update_one(
+            {"_id": ObjectId(conversation_id), "user_id": user_id, **NOT_DELETED},
+            {"$inc": {"version": 1}},
+        )
+    if not result.matched_count:
+        # Deleted after the upsert, the turn must not outlive it
+        with span("mongo", "messages.delete_one"):
+            await messages_collection.delete_one({"_id": turn["_id"]})
+        return None
+    return turn
+
+
+async def conversation_owner(conversation_id):
+    conversation = await conversations_collection.find_one(
+        {"_id": ObjectId(conversation_id), **NOT_DELETED}, {"user_id": 1}
+    )
+    return conversation.get("user_id") if conversation else None
+
+
+async def remove_conversation(conversation_id, user_id):
+    # Pending turn writes are not waited for, the tombstone turns them away
+    with span("mongo", "conversations.update_one"):
+        result = await conversations_collection.update_one(
+            {"_id": ObjectId(conversation_id), "user_id": user_id, **NOT_DELETED},
+            {
+                "$set": {"deleted": True, "deleted_at": datetime.utcnow()},
+                "$unset": {
+                    "title": "",
+                    "preview": "",
+                    "summary": "",
+                    "summary_covered": "",
+                },
+            },
+        )
+    if not result.matched_count:
+        return False
+    with span("mongo", "messages.delete_many"):
+        await messages_collection.delete_many({"conversation_id": str(conversation_id)})
+    history_cache.invalidate(str(conversation_id))
+    return True
+
+
+async def write_turn_with_retries(
+    conversation_id, user_id, entries, created_at, turn_id
+):
+    for attempt in range(1, TURN_WRITE_RETRIES + 1):
+        try:
+            return await append_turn(
+                conversation_id, user_id, entries, created_at, turn_id
+            )
+        except DuplicateKeyError:
+            # Either the id belongs to another user or was deleted, or
+            # another first turn of the same new conversation won the
+            # upsert. Only the last is worth retrying.
+            try:
+                owner = await conversation_owner(conversation_id)
+            except Exception:
+                owner = user_id
+            if owner == user_id and attempt < TURN_WRITE_RETRIES:
+                continue
+            logger.error(
+                "Conversation %s is deleted or not owned by %s, turn %s dropped",
+                conversation_id,
+                user_id,
+                turn_id,
+            )
+            return None
+        except Exception:
+            logger.exception(
+                "Saving turn %s failed (attempt %s/%s)",
+                turn_id,
+                attempt,
+                TURN_WRITE_RETRIES,
+            )
+            if attempt == TURN_WRITE_RETRIES:
+                return None
+            await asyncio.sleep(0.2 * 2**attempt)
+
+
+async def persist_turn(
+    conversation_id, user_id, entries, created_at, turn_id, cache_version
+):
+    turn = await write_turn_with_retries(
+        conversation_id, user_id, entries, created_at, turn_id
+    )
+    others_pending = any(
+        task is not asyncio.current_task() and key == conversation_id
+        for task, (_, key) in _turn_writes.items()
+    )
+    if turn is None or others_pending:
+        # Failed, or another write of the conversation could land out of
+        # order: the next session reloads it from the database instead
+        history_cache.invalidate(conversation_id)
+    else:
+        history_cache.append(conversation_id, to_model_history(entries), cache_version)
+    return turn
+
+
+def schedule_turn_write(conversation_id, user_id, entries, created_at, turn_id):
+    # Runs after the reply is sent. Reads of the same user's conversations
+    # wait for it through settle_turn_writes().
+    task = asyncio.create_task(
+        persist_turn(
+            conversation_id,
+            user_id,
+            entries,
+            created_at,
+            turn_id,
+            history_cache.version(conversation_id),
+        )
+    )
+    _turn_writes[task] = (user_id, conversation_id)
+    task.add_done_callback(lambda done: _turn_writes.pop(done, None))
+    return task
+
+
+async def settle_turn_writes(user_id=None, timeout=TURN_WRITE_SETTLE_TIMEOUT):
+    tasks = [
+        task
+        for task, (owner, _) in _turn_writes.items()
+        if user_id is None or owner == user_id
+    ]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+
+async def drain_turn_writes():
+    await settle_turn_writes(timeout=None)
+
+
+async def list_conversations(user_id, cursor=None, limit=None):
+    query = {"user_id": user_id, **NOT_DELETED}
+    if cursor:
+        updated_at, conversation_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"updated_at": {"$lt": updated_at}},
+            {"updated_at": updated_at, "_id": {"$lt": conversation_id}},
+        ]
+
+    results = conversations_collection.find(
+        query, {"title": 1, "preview": 1, "updated_at": 1, "version": 1}
+    ).sort([("updated_at", DESCENDING), ("_id", DESCENDING)])
+    if limit:
+        results = results.limit(limit + 1)
+    conversations = await results.to_list()
+
+    next_cursor = None
+    if limit and len(conversations) > limit:
+        conversations = conversations[:limit]
+        next_cursor = encode_cursor(conversations[-1], "updated_at")
+    return conversations, next_cursor
+
+
+async def load_turns(conversation_id, cursor=None, limit=None, batch_size=200):
+    query = {"conversation_id": str(conversation_id)}
+    if cursor:
+        created_at, turn_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$gt": created_at}},
+            {"created_at": created_at, "_id": {"$gt": turn_id}},
+        ]
+
+    results = messages_collection.find(query).sort(
+        [("created_at", ASCENDING), ("_id", ASCENDING)]
+    )
+    if limit:
+        # One extra row tells whether another page exists
+        results = results.limit(limit + 1)
+    turns = await results.batch_size(batch_size).to_list()
+
+    next_cursor = None
+    if limit and len(turns) > limit:
+        turns = turns[:limit]
+        next_cursor = encode_cursor(turns[-1])
+    return turns, next_cursor
+
+
+def flatten_turns(turns):
+    return [entry for turn in turns for entry in turn.get("entries", [])]
+
+
+def to_model_history(entries):
+    converted_history = []
+    for msg in entries:
+        for sub_msg in msg.get("messages", []):
+            converted_history.append(
+                {"role": msg["role"], "parts": [{"text": sub_msg["text"]}]}
+            )
+    return converted_history
+
+
+def group_legacy_messages(conversation):
+    # A new turn starts at every user entry, replies attach to the one before
+    turns = []
+    for entry in conversation.get("messages", []):
+        if entry.get("role") == "user" or not turns:
+            try:
+                created_at = datetime.fromisoformat(entry.get("timestamp"))
+            except (TypeError, ValueError):
+                created_at = conversation["_id"].generation_time.replace(tzinfo=None)
+            turns.append(
+                {
+                    "conversation_id": str(conversation["_id"]),
+                    "user_id": conversation.get("user_id"),
+                    "created_at": created_at,
+                    "entries": [],
+                    "migrated": True,
+                }
+            )
+        turns[-1]["entries"].append(entry)
+    return turns
+
+
+async def migrate_embedded_messages(batch_size=100):
+    # Safe to re-run: turns copied by an interrupted run are replaced
+    migrated = 0
+    conversations = conversations_collection.find(
+        {"messages": {"$exists": True}}
+    ).batch_size(batch_size)
+    async for conversation in conversations:
+        conversation_id = str(conversation["_id"])
+        turns = group_legacy_messages(conversation)
+        await messages_collection.delete_many(
+            {"conversation_id": conversation_id, "migrated": True}
+        )
+        if turns:
+            await messages_collection.insert_many(turns)
+        await conversations_collection.update_one(
+            {"_id": conversation["_id"]}, {"$unset": {"messages": ""}}
+        )
+        migrated += 1
+    return migrated
+
+
+async def backfill_conversation_summaries(batch_size=100):
+    backfilled = 0
+    conversations = conversations_collection.find(
+        {"updated_at": {"$exists": False}}, {"_id": 1}
+    ).batch_size(batch_size)
+    async for conversation in conversations:
+        conversation_id = str(conversation["_id"])
+        first_turn = await messages_collection.find_one(
+            {"conversation_id": conversation_id},
+            sort=[("created_at", ASCENDING), ("_id", ASCENDING)],
+        )
+        last_turn = await messages_collection.find_one(
+            {"conversation_id": conversation_id},
+            {"created_at": 1},
+            sort=[("created_at", DESCENDING), ("_id", DESCENDING)],
+        )
+        summary = conversation_summary(
+            entries_text(first_turn["entries"]) if first_turn else ""
+        )
+        summary["updated_at"] = (
+            last_turn["created_at"]
+            if last_turn
+            else conversation["_id"].generation_time.replace(tzinfo=None)
+        )
+        await conversations_collection.update_one(
+            {"_id": conversation["_id"]}, {"$set": summary}
+        )
+        backfilled += 1
+    return backfilled
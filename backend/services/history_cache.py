@@ -0,0 +1,108 @@
+import os
+from collections import OrderedDict
+from services.metrics import Counter
+
+HISTORY_CACHE_MAX_BYTES = int(
+    os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", "2048"))
+
+# Rough per-message overhead of the dict/list wrappers around the text
+MESSAGE_OVERHEAD_BYTES = 200
+
+history_cache_lookups = Counter(
+    "history_cache_lookups_total", "Shared history cache lookups by result"
+)
+history_cache_evictions = Counter(
+    "history_cache_evictions_total", "Histories evicted to stay within the limits"
+)
+
+
+def history_size(messages):
+    return sum(
+        MESSAGE_OVERHEAD_BYTES
+        + sum(len(part.get("text", "")) for part in message["parts"])
+        for message in messages
+    )
+
+
+# Ready-to-send model histories keyed by conversation id, shared by every
+# Chainlit session in the worker. Sessions get a copy of the list, so their
+# own appends never leak into the cache; new turns are added with append().
+# Every put() gets a new version. A turn write notes the version it started
+# from and only appends to that same entry: one rebuilt while the turn was
+# being written may already hold it.
+class HistoryCache:
+    def __init__(
+        self, max_bytes=HISTORY_CACHE_MAX_BYTES, max_entries=HISTORY_CACHE_MAX_ENTRIES
+    ):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self._version = 0
+
+    def get(self, conversation_id):
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            history_cache_lookups.inc(result="miss")
+            return None
+        history_cache_lookups.inc(result="hit")
+        self._entries.move_to_end(conversation_id)
+        return list(entry["history"])
+
+    def put(self, conversation_id, history):
+        self.invalidate(conversation_id)
+        size = history_size(history)
+        if size > self.max_bytes:
+            return
+        self._version += 1
+        self._entries[conversation_id] = {
+            "history": list(history),
+            "bytes": size,
+            "version": self._version,
+        }
+        self.bytes += size
+        self._evict()
+
+    def version(self, conversation_id):
+        entry = self._entries.get(conversation_id)
+        return entry["version"] if entry is not None else None
+
+    def append(self, conversation_id, messages, version):
+        # Only conversations already cached are extended, others load on demand
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        if entry["version"] != version:
+            self.invalidate(conversation_id)
+            return
+        size = history_size(messages)
+        entry["history"].extend(messages)
+        entry["bytes"] += size
+        self.bytes += size
+        self._entries.move_to_end(conversation_id)
+        self._evict()
+
+    def invalidate(self, conversation_id):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.bytes -= entry["bytes"]
+
+    def _evict(self):
+        while self._entries and (
+            self.bytes > self.max_bytes or len(self._entries) > self.max_entries
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry["bytes"]
+            history_cache_evictions.inc()
+
+    def snapshot(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+history_cache = HistoryCache()
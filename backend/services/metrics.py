@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Turns slower than this (seconds) are logged with their stage breakdown,
+# 0 turns the log off
+SLOW_TURN_SECONDS = float(os.getenv("SLOW_TURN_SECONDS", "0"))
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+_metrics = []
+_gauge_collectors = []
+_turn = contextvars.ContextVar("metrics_turn", default=None)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels)
+        + "}"
+    )
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = {
+                "counts": [0] * len(self.buckets),
+                "sum": 0.0,
+                "count": 0,
+            }
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry["counts"][i] += 1
+        entry["sum"] += value
+        entry["count"] += 1
+
+    def samples(self):
+        for key, entry in self._values.items():
+            for bound, count in zip(self.buckets, entry["counts"]):
+                yield f"{self.name}_bucket", key + (("le", f"{bound:g}"),), count
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), entry["count"]
+            yield f"{self.name}_sum", key, entry["sum"]
+            yield f"{self.name}_count", key, entry["count"]
+
+
+stage_seconds = Histogram(
+    "stage_duration_seconds", "Time spent in one stage of a request or chat turn"
+)
+stage_errors = Counter("stage_errors_total", "Stages that ended with an exception")
+turn_seconds = Histogram("chat_turn_duration_seconds", "Whole chat turns")
+turns_total = Counter("chat_turns_total", "Chat turns by response type")
+slow_turns_total = Counter(
+    "chat_slow_turns_total", "Chat turns slower than SLOW_TURN_SECONDS"
+)
+http_seconds = Histogram(
+    "http_request_duration_seconds", "FastAPI requests by route and status"
+)
+
+
+def register_gauges(collector):
+    # collector() returns {name: (help, {labels tuple: value})}, read on scrape
+    _gauge_collectors.append(collector)
+
+
+@contextmanager
+def span(stage, detail=""):
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage, detail=detail)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage, detail=detail)
+        breakdown = _turn.get()
+        if breakdown is not None:
+            key = f"{stage}:{detail}" if detail else stage
+            breakdown[key] = breakdown.get(key, 0.0) + elapsed
+
+
+@contextmanager
+def turn_trace(conversation_id_getter):
+    # Spans inside the turn, including those of tasks it starts, add up in
+    # one breakdown that is logged when the turn is slow
+    breakdown = {}
+    token = _turn.set(breakdown)
+    started = time.perf_counter()
+    try:
+        yield breakdown
+    finally:
+        _turn.reset(token)
+        elapsed = time.perf_counter() - started
+        turn_seconds.observe(elapsed)
+        if SLOW_TURN_SECONDS and elapsed >= SLOW_TURN_SECONDS:
+            slow_turns_total.inc()
+            logger.warning(
+                "Slow turn %.2fs in conversation %s: %s",
+                elapsed,
+                conversation_id_getter(),
+                json.dumps({k: round(v, 3) for k, v in breakdown.items()}),
+            )
+
+
+def render_metrics():
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    for collector in _gauge_collectors:
+        for name, (help, values) in collector().items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values.items():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Pure ASGI so streamed responses pass through untouched
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_seconds.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=status["code"],
+            )
@@ -0,0 +1,48 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from services.scheduler import AdmissionScheduler
+
+# bcrypt is deliberately slow, so it runs on a few worker threads instead of
+# the event loop. Extra logins wait in a bounded queue and are turned away
+# once it is full, rather than piling up behind each other.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_MAX_QUEUE = int(os.getenv("PASSWORD_MAX_QUEUE", "64"))
+PASSWORD_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_QUEUE_TIMEOUT", "5"))
+
+_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt"
+)
+
+password_scheduler = AdmissionScheduler(
+    "Password hashing", PASSWORD_WORKERS, PASSWORD_MAX_QUEUE, PASSWORD_QUEUE_TIMEOUT
+)
+
+
+def _release_slot(future):
+    password_scheduler.release()
+    if not future.cancelled():
+        future.exception()  # retrieved, the caller may be gone
+
+
+async def run_in_pool(fn, *args):
+    await password_scheduler.acquire()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    except BaseException:
+        password_scheduler.release()
+        raise
+    # The thread can't be stopped, so a cancelled request (a client that
+    # disconnected) keeps the slot until bcrypt is done with it
+    future.add_done_callback(_release_slot)
+    return await asyncio.shield(future)
+
+
+async def hash_password(password):
+    return await run_in_pool(db.hash_password, password)
+
+
+async def verify_password(password, hashed):
+    return await run_in_pool(db.verify_password, password, hashed)
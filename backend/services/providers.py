@@ -0,0 +1,169 @@
+import os
+import json
+import asyncio
+from dataclasses import dataclass
+
+import httpx
+from llm import MODEL_REGISTRY
+from services.clients import get_gemini_model, get_http_client
+from services.scheduler import AdmissionScheduler
+
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL")
+
+# Calls beyond a model's max_concurrency wait in a bounded queue. A local
+# Ollama only runs a few generations at once, so most waiting happens there.
+QUEUE_LIMITS = {
+    "gemini": (
+        int(os.getenv("GEMINI_MAX_QUEUE", "256")),
+        float(os.getenv("GEMINI_QUEUE_TIMEOUT", "15")),
+    ),
+    "ollama": (
+        int(os.getenv("OLLAMA_MAX_QUEUE", "32")),
+        float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "15")),
+    ),
+}
+
+model_schedulers = {
+    spec.name: AdmissionScheduler(
+        spec.name, spec.max_concurrency, *QUEUE_LIMITS[spec.provider]
+    )
+    for spec in MODEL_REGISTRY.values()
+}
+
+
+class ProviderError(Exception):
+    pass
+
+
+class ProviderTimeout(ProviderError):
+    pass
+
+
+@dataclass
+class Completion:
+    model: str
+    text: str
+    prompt_token_count: int = 0
+    candidates_token_count: int = 0
+
+
+async def generate_gemini(
+    model_name,
+    history,
+    content,
+    timeout,
+    on_token=None,
+    max_output_tokens=None,
+):
+    convo = get_gemini_model(model_name).start_chat(history=history)
+    request_options = {"timeout": timeout}
+    generation_config = (
+        {"max_output_tokens": max_output_tokens} if max_output_tokens else None
+    )
+
+    async def complete():
+        if on_token is None:
+            response = await convo.send_message_async(
+                content,
+                generation_config=generation_config,
+                request_options=request_options,
+            )
+            return response, response.text
+
+        # Forward each chunk as soon as Gemini produces it
+        response = await convo.send_message_async(
+            content,
+            stream=True,
+            generation_config=generation_config,
+            request_options=request_options,
+        )
+        parts = []
+        async for chunk in response:
+            for candidate in chunk.candidates:
+                for part in candidate.content.parts:
+                    if part.text:
+                        parts.append(part.text)
+                        await on_token(part.text)
+        return response, "".join(parts)
+
+    try:
+        response, text = await asyncio.wait_for(complete(), timeout)
+    except asyncio.TimeoutError:
+        raise ProviderTimeout(f"{model_name} did not answer within {timeout:g}s")
+
+    usage = response.usage_metadata
+    return Completion(
+        model=model_name,
+        text=text,
+        prompt_token_count=getattr(usage, "prompt_token_count", 0),
+        candidates_token_count=getattr(usage, "candidates_token_count", 0),
+    )
+
+
+async def generate_ollama(
+    model_name, content, timeout, on_token=None, max_output_tokens=None
+):
+    payload = {
+        "model": model_name,
+        "messages": [{"role": "user", "content": content}],
+        "stream": on_token is not None,
+    }
+    if max_output_tokens:
+        payload["options"] = {"num_predict": max_output_tokens}
+
+    async def complete():
+        client = get_http_client()
+        if on_token is None:
+            response = await client.post(OLLAMA_API_URL, json=payload)
+            response.raise_for_status()
+            response_json = response.json()
+            return response_json, response_json.get("message", {}).get("content")
+
+        # Ollama streams one JSON object per line, usage arrives with "done"
+        parts = []
+        response_json = {}
+        async with client.stream("POST", OLLAMA_API_URL, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                response_json = json.loads(line)
+                token = response_json.get("message", {}).get("content")
+                if token:
+                    parts.append(token)
+                    await on_token(token)
+                if response_json.get("done"):
+                    break
+        return response_json, "".join(parts) or None
+
+    try:
+        response_json, text = await asyncio.wait_for(complete(), timeout)
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        raise ProviderTimeout(f"{model_name} did not answer within {timeout:g}s")
+    if not text:
+        # An error, not an answer: never cached or shared with coalesced callers
+        raise ProviderError(f"No content returned from Ollama for {model_name}")
+
+    return Completion(
+        model=model_name,
+        text=text,
+        prompt_token_count=response_json.get("prompt_eval_count", 0),
+        candidates_token_count=response_json.get("eval_count", 0),
+    )
+
+
+async def generate(
+    spec, history, content, on_token=None, priority=0, max_output_tokens=None
+):
+    # The model's timeout (from MODEL_REGISTRY, the only place it is set)
+    # covers generation only, queueing has its own
+    async with model_schedulers[spec.name].slot(priority):
+        if spec.provider == "gemini":
+            return await generate_gemini(
+                spec.name, history, content, spec.timeout, on_token, max_output_tokens
+            )
+        if spec.provider == "ollama":
+            return await generate_ollama(
+                spec.name, content, spec.timeout, on_token, max_output_tokens
+            )
+    raise ProviderError(f"Unknown provider {spec.provider!r} for {spec.name}")
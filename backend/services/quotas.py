@@ -0,0 +1,231 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from db import usage_metadata_collection
+from services.metrics import Counter, span
+
+logger = logging.getLogger(__name__)
+
+# Chat turns a user can start per minute, with bursts up to USER_REQUEST_BURST
+USER_REQUESTS_PER_MINUTE = float(os.getenv("USER_REQUESTS_PER_MINUTE", "20"))
+USER_REQUEST_BURST = int(os.getenv("USER_REQUEST_BURST", "10"))
+# Model tokens (prompt + output) a user can spend per sliding window.
+# Either limit is off when set to 0.
+USER_TOKENS_PER_WINDOW = int(os.getenv("USER_TOKENS_PER_WINDOW", "200000"))
+USER_TOKEN_WINDOW = int(os.getenv("USER_TOKEN_WINDOW", "3600"))
+# How often a user's token count is re-read from usage_metadata, which also
+# holds what the other workers recorded
+QUOTA_RECONCILE_INTERVAL = float(os.getenv("QUOTA_RECONCILE_INTERVAL", "30"))
+QUOTA_MAX_USERS = int(os.getenv("QUOTA_MAX_USERS", "10000"))
+
+BUCKET_SECONDS = 60
+
+admitted_turns = Counter(
+    "chat_admitted_turns_total", "Chat turns let through by the per-user limits"
+)
+rejected_turns = Counter(
+    "chat_rejected_turns_total", "Chat turns refused by the per-user limits"
+)
+quota_reconciles = Counter(
+    "quota_reconciles_total", "Token usage re-reads from usage_metadata by result"
+)
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason} limit reached, retry in {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def minute_bucket(value):
+    return int(
+        datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+        // BUCKET_SECONDS
+    )
+
+
+class UserQuota:
+    def __init__(self, burst, now):
+        self.allowance = burst
+        self.refilled_at = now
+        self.stored = {}  # minute bucket -> tokens, as read from usage_metadata
+        # (time, tokens, event id) recorded by this worker and not yet seen
+        # in usage_metadata
+        self.recent = []
+        self.reconciled_at = None
+        self.reconciling = None
+
+    def tokens_used(self, now, window):
+        start = now - window
+        first_bucket = int(start // BUCKET_SECONDS)
+        return sum(
+            tokens for bucket, tokens in self.stored.items() if bucket >= first_bucket
+        ) + sum(tokens for at, tokens, _ in self.recent if at >= start)
+
+    def tokens_retry_after(self, now, window, limit):
+        # Seconds until enough of the oldest usage leaves the window
+        usage = [
+            (bucket * BUCKET_SECONDS + BUCKET_SECONDS, tokens)
+            for bucket, tokens in self.stored.items()
+        ] + [(at, tokens) for at, tokens, _ in self.recent]
+        used = self.tokens_used(now, window)
+        for expires, tokens in sorted(usage):
+            if expires < now - window:
+                continue
+            used -= tokens
+            if used < limit:
+                return max(expires + window - now, 1.0)
+        return float(window)
+
+
+# Token buckets per user for the request rate, plus a sliding window of
+# spent tokens kept from the usage recorder and reconciled with
+# usage_metadata. Events still queued in the recorder of another worker
+# are only seen on a later reconcile.
+class UserLimiter:
+    def __init__(
+        self,
+        requests_per_minute=USER_REQUESTS_PER_MINUTE,
+        burst=USER_REQUEST_BURST,
+        tokens_per_window=USER_TOKENS_PER_WINDOW,
+        window=USER_TOKEN_WINDOW,
+        reconcile_interval=QUOTA_RECONCILE_INTERVAL,
+        max_users=QUOTA_MAX_USERS,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.tokens_per_window = tokens_per_window
+        self.window = window
+        self.reconcile_interval = reconcile_interval
+        self.max_users = max_users
+        self._users = OrderedDict()
+
+    def _state(self, user_id, now):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = UserQuota(self.burst, now)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    async def admit(self, user_id):
+        now = time.time()
+        state = self._state(user_id, now)
+
+        if self.tokens_per_window:
+            if state.reconciled_at is None:
+                await self.reconcile(user_id, state)
+            elif now - state.reconciled_at >= self.reconcile_interval and (
+                state.reconciling is None or state.reconciling.done()
+            ):
+                # Refreshed in the background, this turn uses the last count
+                state.reconciling = asyncio.create_task(self.reconcile(user_id, state))
+            if state.tokens_used(now, self.window) >= self.tokens_per_window:
+                rejected_turns.inc(reason="tokens")
+                raise QuotaExceeded(
+                    "tokens",
+                    state.tokens_retry_after(now, self.window, self.tokens_per_window),
+                )
+
+        if self.requests_per_minute:
+            rate = self.requests_per_minute / 60
+            state.allowance = min(
+                self.burst, state.allowance + (now - state.refilled_at) * rate
+            )
+            state.refilled_at = now
+            if state.allowance < 1:
+                rejected_turns.inc(reason="requests")
+                raise QuotaExceeded("requests", (1 - state.allowance) / rate)
+            state.allowance -= 1
+
+        admitted_turns.inc()
+
+    def within_token_limit(self, user_id):
+        # For background calls made on a user's behalf, checked without
+        # spending a request
+        if not self.tokens_per_window:
+            return True
+        state = self._users.get(user_id)
+        return (
+            state is None
+            or state.tokens_used(time.time(), self.window) < self.tokens_per_window
+        )
+
+    def add_tokens(self, user_id, tokens, event_id):
+        if not self.tokens_per_window or not tokens:
+            return
+        state = self._users.get(user_id)
+        # Unknown users are read from usage_metadata on their next turn
+        if state is not None:
+            state.recent.append((time.time(), tokens, event_id))
+
+    async def reconcile(self, user_id, state):
+        started = time.time()
+        since = datetime.utcfromtimestamp(started - self.window)
+        pipeline = [
+            {"$match": {"user_id": user_id, "timestamp": {"$gte": since}}},
+            {
+                "$group": {
+                    "_id": {
+                        "$dateToString": {
+                            "format": "%Y-%m-%dT%H:%M",
+                            "date": "$timestamp",
+                        }
+                    },
+                    "tokens": {
+                        "$sum": {
+                            "$add": [
+                                "$prompt_token_count",
+                                "$candidates_token_count",
+                            ]
+                        }
+                    },
+                }
+            },
+        ]
+        recent_ids = [event_id for _, _, event_id in state.recent]
+        try:
+            # Which of this worker's events are stored, asked before the
+            # totals so every one found is counted in them
+            with span("mongo", "usage_metadata.find"):
+                flushed = {
+                    doc["_id"]
+                    async for doc in usage_metadata_collection.find(
+                        {"_id": {"$in": recent_ids}}, {"_id": 1}
+                    )
+                }
+            with span("mongo", "usage_metadata.aggregate"):
+                stored = {
+                    minute_bucket(item["_id"]): item["tokens"]
+                    async for item in await usage_metadata_collection.aggregate(
+                        pipeline
+                    )
+                }
+        except Exception:
+            # Keep admitting on the local count and try again later
+            quota_reconciles.inc(result="error")
+            logger.exception("Could not read token usage of %s", user_id)
+            state.reconciled_at = started
+            return
+        state.stored = stored
+        # Events still queued in the usage recorder, or in a batch waiting
+        # for its retry, are kept until a later reconcile finds them
+        state.recent = [
+            entry
+            for entry in state.recent
+            if entry[2] not in flushed and entry[0] >= started - self.window
+        ]
+        state.reconciled_at = started
+        quota_reconciles.inc(result="ok")
+
+    def snapshot(self):
+        return {"users": len(self._users)}
+
+
+user_limiter = UserLimiter()
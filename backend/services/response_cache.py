@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from services.metrics import Counter
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "disk")
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_BYTES", str(100 * 1024 * 1024))
+)
+
+response_cache_lookups = Counter(
+    "response_cache_lookups_total", "Response cache lookups by result"
+)
+response_cache_stores = Counter("response_cache_stores_total", "Responses cached")
+
+
+def history_fingerprint(history):
+    digest = hashlib.sha256()
+    for message in history:
+        digest.update(message["role"].encode("utf-8"))
+        for part in message["parts"]:
+            digest.update(b"\0")
+            digest.update(part.get("text", "").encode("utf-8"))
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+
+def cache_key(model_name, generation_settings, history, prompt):
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "settings": generation_settings,
+            "history": history_fingerprint(history),
+            "prompt": prompt,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            self.delete(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.delete(key)
+        self._data[key] = (value, time.time() + self.ttl)
+        self.bytes += len(value.encode("utf-8"))
+        while self.bytes > self.max_bytes and self._data:
+            self.delete(next(iter(self._data)))
+
+    def delete(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[0].encode("utf-8"))
+
+    def size(self):
+        return len(self._data), self.bytes
+
+
+# SQLite file next to the app, so cached answers survive restarts
+class DiskBackend:
+    def __init__(self, path, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)"
+        )
+        self._conn.commit()
+        # Kept up to date by set(), so size() never touches the file
+        self.entries, self.bytes = self._count()
+
+    def _count(self):
+        return self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now + self.ttl, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            entries, total = self._count()
+            if total > self.max_bytes:
+                # Least recently read entries go first
+                for old_key, size in self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed_at"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE key = ?", (old_key,)
+                    )
+                    entries -= 1
+                    total -= size
+            self._conn.commit()
+            self.entries, self.bytes = entries, total
+
+    def size(self):
+        return self.entries, self.bytes
+
+
+class ResponseCache:
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, backend=None):
+        self.enabled = enabled
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            if RESPONSE_CACHE_BACKEND == "memory":
+                self._backend = MemoryBackend(
+                    RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL
+                )
+            else:
+                self._backend = DiskBackend(
+                    RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL
+                )
+        return self._backend
+
+    def key(self, model_name, generation_settings, history, prompt, bypass=False):
+        # None means "don't use the cache for this request"
+        if not self.enabled:
+            return None
+        if bypass:
+            response_cache_lookups.inc(result="bypassed")
+            return None
+        return cache_key(model_name, generation_settings, history, prompt)
+
+    async def get(self, key):
+        value = await asyncio.to_thread(self.backend.get, key)
+        response_cache_lookups.inc(result="hit" if value is not None else "miss")
+        return value
+
+    async def set(self, key, value):
+        await asyncio.to_thread(self.backend.set, key, value)
+        response_cache_stores.inc()
+
+    def snapshot(self):
+        # Not opened just to be counted
+        backend = self._backend if self.enabled else None
+        entries, size = backend.size() if backend else (0, 0)
+        return {"enabled": self.enabled, "entries": entries, "bytes": size}
+
+
+response_cache = ResponseCache()
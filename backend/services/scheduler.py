@@ -0,0 +1,102 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from services.metrics import Counter, Histogram
+
+scheduler_waits = Histogram(
+    "scheduler_wait_seconds", "Time calls waited for a slot, by scheduler"
+)
+scheduler_rejected = Counter(
+    "scheduler_rejected_total", "Calls turned away by a scheduler, by reason"
+)
+
+
+class SchedulerRejected(Exception):
+    pass
+
+
+class SchedulerQueueFull(SchedulerRejected):
+    pass
+
+
+class SchedulerQueueTimeout(SchedulerRejected):
+    pass
+
+
+# Admits at most max_concurrency calls at a time. Callers beyond that wait
+# in a bounded priority queue (lower number first, FIFO within a priority)
+# and fail fast once the queue is full or they have waited queue_timeout.
+class AdmissionScheduler:
+    def __init__(self, name, max_concurrency, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queued = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def _record_wait(self, waited):
+        scheduler_waits.observe(waited, scheduler=self.name)
+
+    async def acquire(self, priority=0):
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            self._record_wait(0.0)
+            return
+
+        if self._queued >= self.max_queue:
+            scheduler_rejected.inc(scheduler=self.name, reason="full")
+            raise SchedulerQueueFull(
+                f"{self.name} is overloaded ({self._queued} requests waiting), "
+                "please try again shortly"
+            )
+
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        self._queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up, pass it on
+                self.release()
+            else:
+                self._queued -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                scheduler_rejected.inc(scheduler=self.name, reason="timeout")
+                raise SchedulerQueueTimeout(
+                    f"{self.name} is busy, no slot freed up within "
+                    f"{self.queue_timeout:g}s, please try again shortly"
+                )
+            raise
+        self._record_wait(time.perf_counter() - started)
+
+    def release(self):
+        # Hand the slot straight to the next live waiter, if any
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._queued -= 1
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        return {
+            "active": self._active,
+            "queue_depth": self._queued,
+            "max_concurrency": self.max_concurrency,
+        }
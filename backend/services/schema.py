@@ -0,0 +1,274 @@
+import os
+import sys
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from db import db, schema_migrations_collection
+from services.history import backfill_conversation_summaries, migrate_embedded_messages
+from services.search import explain_search
+from services.usage import backfill_usage_rollups
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_AUTO_MIGRATE = os.getenv("SCHEMA_AUTO_MIGRATE", "true").lower() == "true"
+# Off when indexes and migrations are applied by `python -m services.schema`
+# as a deploy step instead of by each worker
+SCHEMA_ON_STARTUP = os.getenv("SCHEMA_ON_STARTUP", "true").lower() == "true"
+SEARCH_LANGUAGE = os.getenv("SEARCH_LANGUAGE", "none")
+# A claim still "running" after this long is from a crashed worker and is
+# taken over by the next one
+MIGRATION_CLAIM_TIMEOUT = float(os.getenv("MIGRATION_CLAIM_TIMEOUT", "3600"))
+
+# Every index the queries in app.py, cl_app.py and services/ rely on
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+    ],
+    "conversations": [
+        IndexModel(
+            [("user_id", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)]
+        ),
+    ],
+    "messages": [
+        IndexModel(
+            [
+                ("conversation_id", ASCENDING),
+                ("created_at", ASCENDING),
+                ("_id", ASCENDING),
+            ]
+        ),
+        # /search, always scoped to one user. The language is fixed when the
+        # index is built, "none" matches words as typed in any language.
+        IndexModel(
+            [("user_id", ASCENDING), ("entries.messages.text", TEXT)],
+            name="messages_text",
+            default_language=SEARCH_LANGUAGE,
+        ),
+    ],
+    "usage_metadata": [
+        IndexModel(
+            [("user_id", ASCENDING), ("model", ASCENDING), ("timestamp", ASCENDING)]
+        ),
+        IndexModel(
+            [("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]
+        ),
+        # Events a failed flush left out of usage_daily
+        IndexModel(
+            [("rolled_up", ASCENDING), ("timestamp", ASCENDING)],
+            partialFilterExpression={"rolled_up": False},
+        ),
+    ],
+    "usage_daily": [
+        IndexModel(
+            [("user_id", ASCENDING), ("date", ASCENDING), ("model", ASCENDING)],
+            unique=True,
+        ),
+    ],
+}
+
+# Applied once per database, in order. Steps must be safe to re-run.
+MIGRATIONS = [
+    (1, "move embedded conversation messages", migrate_embedded_messages),
+    (2, "backfill conversation previews", backfill_conversation_summaries),
+    (3, "backfill daily usage rollups", backfill_usage_rollups),
+]
+
+
+async def duplicate_keys(collection_name, index, limit=20):
+    # Values that break a unique index, e.g. emails registered twice before
+    # the index existed
+    fields = [field for field, _ in index.document["key"].items()]
+    pipeline = [
+        {
+            "$group": {
+                "_id": {field.replace(".", "_"): f"${field}" for field in fields},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit},
+    ]
+    return [
+        (item["_id"], item["count"])
+        async for item in await db[collection_name].aggregate(pipeline)
+    ]
+
+
+async def ensure_indexes():
+    # One index at a time, so existing data that breaks one of them doesn't
+    # keep the others from being built or the worker from starting
+    failed = []
+    for collection_name, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                failed.append((collection_name, index_keys(index)))
+                logger.error(
+                    "Could not create index %s on %s: %s",
+                    index_keys(index),
+                    collection_name,
+                    e,
+                )
+                if e.code == 11000:
+                    for value, count in await duplicate_keys(collection_name, index):
+                        logger.error(
+                            "Duplicate %s: %s (%s documents)",
+                            collection_name,
+                            value,
+                            count,
+                        )
+    return failed
+
+
+def index_keys(index):
+    keys = list(index.document["key"].items())
+    if any(direction == TEXT for _, direction in keys):
+        # The server lists the text fields as one _fts/_ftsx pair
+        keys = [(f, d) for f, d in keys if d != TEXT] + [("_fts", TEXT), ("_ftsx", 1)]
+    return keys
+
+
+async def missing_indexes():
+    missing = []
+    for collection_name, indexes in INDEXES.items():
+        index_information = await db[collection_name].index_information()
+        existing = [list(info["key"]) for info in index_information.values()]
+        for index in indexes:
+            keys = index_keys(index)
+            if keys not in existing:
+                missing.append((collection_name, keys))
+    return missing
+
+
+async def applied_migrations():
+    return {
+        doc["_id"]
+        async for doc in schema_migrations_collection.find(
+            {"state": "applied"}, {"_id": 1}
+        )
+    }
+
+
+async def take_over_stale_claim(version):
+    now = datetime.utcnow()
+    result = await schema_migrations_collection.update_one(
+        {
+            "_id": version,
+            "state": "running",
+            "started_at": {"$lt": now - timedelta(seconds=MIGRATION_CLAIM_TIMEOUT)},
+        },
+        {"$set": {"started_at": now}},
+    )
+    return result.modified_count == 1
+
+
+async def run_migrations():
+    applied = await applied_migrations()
+    ran = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        # Claim the version so concurrent workers don't run it twice
+        try:
+            await schema_migrations_collection.insert_one(
+                {
+                    "_id": version,
+                    "name": name,
+                    "state": "running",
+                    "started_at": datetime.utcnow(),
+                }
+            )
+        except DuplicateKeyError:
+            if not await take_over_stale_claim(version):
+                logger.info("Migration %s is already claimed, skipping", version)
+                break
+            logger.warning("Migration %s had a stale claim, running it again", version)
+
+        try:
+            result = await migrate()
+        except Exception:
+            await schema_migrations_collection.delete_one({"_id": version})
+            raise
+        await schema_migrations_collection.update_one(
+            {"_id": version},
+            {
+                "$set": {
+                    "state": "applied",
+                    "applied_at": datetime.utcnow(),
+                    "result": result,
+                }
+            },
+        )
+        logger.info("Applied migration %s (%s): %s", version, name, result)
+        ran.append(version)
+    return ran
+
+
+async def bootstrap_schema():
+    await ensure_indexes()
+    if SCHEMA_AUTO_MIGRATE:
+        await run_migrations()
+    for collection_name, keys in await missing_indexes():
+        logger.warning("Missing index on %s: %s", collection_name, keys)
+
+
+_bootstrap_task = None
+
+
+def start_bootstrap():
+    # Runs in the background so a worker serves (and /ready answers) while
+    # MongoDB is slow or down. A failed attempt is retried on the next call.
+    global _bootstrap_task
+    task = _bootstrap_task
+    if task is None or (task.done() and (task.cancelled() or task.exception())):
+        _bootstrap_task = asyncio.create_task(bootstrap_schema())
+    return _bootstrap_task
+
+
+def bootstrap_status():
+    task = _bootstrap_task
+    if task is None:
+        return "not started"
+    if not task.done():
+        return "running"
+    if task.cancelled():
+        return "cancelled"
+    if task.exception():
+        return f"failed: {task.exception()}"
+    return "ready"
+
+
+async def main(argv):
+    if "--check" in argv:
+        missing = await missing_indexes()
+        applied = await applied_migrations()
+        pending = [version for version, _, _ in MIGRATIONS if version not in applied]
+        for collection_name, keys in missing:
+            print(f"missing index {collection_name}: {keys}")
+            for index in INDEXES[collection_name]:
+                if index_keys(index) == keys and index.document.get("unique"):
+                    for value, count in await duplicate_keys(collection_name, index):
+                        print(f"  duplicate {value}: {count} documents")
+        print(f"pending migrations: {pending or 'none'}")
+        try:
+            stages = await explain_search()
+        except OperationFailure as e:
+            stages = [f"error: {e}"]
+        search_ok = "TEXT_MATCH" in stages
+        print(
+            f"search plan: {' > '.join(stages)}{'' if search_ok else ' (no text index)'}"
+        )
+        return 1 if missing or pending or not search_ok else 0
+    failed = await ensure_indexes()
+    for collection_name, keys in failed:
+        print(f"could not create index {collection_name}: {keys}")
+    print(f"Applied migrations: {await run_migrations() or 'none'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
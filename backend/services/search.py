@@ -0,0 +1,142 @@
+import os
+import re
+from pymongo import DESCENDING
+from bson import ObjectId
+from db import conversations_collection, messages_collection
+
+# Full-text search over a user's turns, backed by the text index on
+# messages (user_id, entries.messages.text) declared in services/schema.py.
+# Results are ranked by textScore, so pages are offsets rather than keysets.
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+# Deepest result a client can page to
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "500"))
+SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "160"))
+
+
+def search_terms(query):
+    # Quoted phrases and plain words, negated words are not highlighted
+    phrases = re.findall(r'"([^"]+)"', query)
+    words = [
+        word
+        for word in re.sub(r'"[^"]*"', " ", query).split()
+        if not word.startswith("-")
+    ]
+    return [term.lower() for term in phrases + words if term.strip()]
+
+
+def make_snippet(entries, terms, size=SNIPPET_CHARS):
+    texts = [
+        message.get("text", "")
+        for entry in entries
+        for message in entry.get("messages", [])
+    ]
+    for text in texts:
+        lowered = text.lower()
+        positions = [p for p in (lowered.find(term) for term in terms) if p >= 0]
+        if positions:
+            start = max(min(positions) - size // 3, 0)
+            break
+    else:
+        # The index stems words, so a hit may not contain the query verbatim
+        text, start = (texts[0] if texts else ""), 0
+
+    end = start + size
+    snippet = " ".join(text[start:end].split())
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(text):
+        snippet += "…"
+    return snippet
+
+
+def search_offset(cursor):
+    if not cursor:
+        return 0
+    if not cursor.isdigit():
+        raise ValueError(f"Invalid search cursor: {cursor}")
+    return int(cursor)
+
+
+def search_query(user_id, query):
+    # Filter, projection and sort of a search. The fake Mongo of the bench
+    # has no $text, `python -m services.schema --check` explains this same
+    # query against the real server instead.
+    return (
+        {"user_id": user_id, "$text": {"$search": query}},
+        {
+            "score": {"$meta": "textScore"},
+            "conversation_id": 1,
+            "created_at": 1,
+            "entries": 1,
+        },
+        [("score", {"$meta": "textScore"}), ("created_at", DESCENDING)],
+    )
+
+
+def plan_stages(node):
+    if isinstance(node, list):
+        return [stage for item in node for stage in plan_stages(item)]
+    if not isinstance(node, dict):
+        return []
+    stages = [node["stage"]] if "stage" in node else []
+    return stages + [stage for value in node.values() for stage in plan_stages(value)]
+
+
+async def explain_search(query="check"):
+    # Stages of the winning plan, TEXT_MATCH when the text index serves it
+    query_filter, projection, sort = search_query("", query)
+    plan = await (
+        messages_collection.find(query_filter, projection).sort(sort).limit(1).explain()
+    )
+    return plan_stages(plan["queryPlanner"]["winningPlan"])
+
+
+async def search_turns(user_id, query, cursor=None, limit=None):
+    limit = min(max(limit or SEARCH_PAGE_SIZE, 1), SEARCH_MAX_PAGE_SIZE)
+    offset = search_offset(cursor)
+    if offset >= SEARCH_MAX_RESULTS:
+        return [], None
+
+    query_filter, projection, sort = search_query(user_id, query)
+    results = (
+        messages_collection.find(query_filter, projection)
+        .sort(sort)
+        .skip(offset)
+        .limit(limit + 1)
+    )
+    turns = await results.to_list()
+
+    next_cursor = None
+    if len(turns) > limit:
+        turns = turns[:limit]
+        if offset + limit < SEARCH_MAX_RESULTS:
+            next_cursor = str(offset + limit)
+
+    conversation_ids = {turn["conversation_id"] for turn in turns}
+    titles = {
+        str(conversation["_id"]): conversation.get("title", "")
+        async for conversation in conversations_collection.find(
+            {
+                "_id": {"$in": [ObjectId(c) for c in conversation_ids]},
+                "user_id": user_id,
+            },
+            {"title": 1},
+        )
+    }
+
+    terms = search_terms(query)
+    hits = []
+    for turn in turns:
+        hits.append(
+            {
+                "conversation_id": turn["conversation_id"],
+                "title": titles.get(turn["conversation_id"], ""),
+                "turn_id": str(turn["_id"]),
+                "created_at": turn["created_at"],
+                "score": round(turn["score"], 4),
+                "snippet": make_snippet(turn.get("entries", []), terms),
+            }
+        )
+    return hits, next_cursor
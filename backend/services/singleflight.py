@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+import logging
+from services.metrics import Counter
+from services.response_cache import history_fingerprint
+
+logger = logging.getLogger(__name__)
+
+flight_calls = Counter("singleflight_calls_total", "Shared upstream calls started")
+flight_coalesced = Counter(
+    "singleflight_coalesced_total", "Callers that joined a call already in flight"
+)
+flight_cancelled = Counter(
+    "singleflight_cancelled_total", "Shared calls cancelled after every caller left"
+)
+
+
+def flight_key(model_name, generation_settings, history, prompt):
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "settings": generation_settings,
+            "history": history_fingerprint(history),
+            "prompt": " ".join(prompt.split()),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.owned = False
+        self.tokens = []
+        self.subscribers = []
+
+
+# Concurrent calls with the same key share one upstream call. The call runs
+# in its own task, so it survives any single caller being cancelled, and is
+# only cancelled once every caller has gone. Nothing is kept after it ends.
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+
+    async def do(self, key, fn, on_token=None):
+        # fn(on_token) makes the upstream call. Returns (result, owner),
+        # owner is True for exactly one caller that got the result, the
+        # one that should account for it.
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            # Streamed upstream only when the caller starting it streams
+            flight.task = asyncio.create_task(
+                fn(self._broadcaster(flight) if on_token else None)
+            )
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            flight_calls.inc(name=self.name)
+        else:
+            flight_coalesced.inc(name=self.name)
+
+        flight.waiters += 1
+        queue = pump = None
+        try:
+            if on_token:
+                # Each caller drains its own queue from a task it starts, so
+                # tokens go out through that caller's Chainlit context rather
+                # than the one the shared call was started from. Late callers
+                # first get what was already streamed.
+                queue = asyncio.Queue()
+                if flight.tokens:
+                    queue.put_nowait("".join(flight.tokens))
+                flight.subscribers.append(queue)
+                pump = asyncio.create_task(self._pump(flight, queue, on_token))
+            result = await asyncio.shield(flight.task)
+            if pump:
+                queue.put_nowait(None)
+                await pump
+        finally:
+            flight.waiters -= 1
+            if queue in flight.subscribers:
+                flight.subscribers.remove(queue)
+            if pump and not pump.done():
+                pump.cancel()
+            if flight.waiters == 0 and not flight.task.done():
+                flight_cancelled.inc(name=self.name)
+                self._forget(key, flight)
+                flight.task.cancel()
+
+        owner = not flight.owned
+        flight.owned = True
+        return result, owner
+
+    async def _pump(self, flight, queue, on_token):
+        while True:
+            tokens = [await queue.get()]
+            while tokens[-1] is not None and not queue.empty():
+                tokens.append(queue.get_nowait())
+            done = tokens[-1] is None
+            text = "".join(token for token in tokens if token is not None)
+            try:
+                if text:
+                    await on_token(text)
+            except Exception:
+                # A closed stream must not fail the shared call
+                logger.exception("%s stream subscriber failed", self.name)
+                if queue in flight.subscribers:
+                    flight.subscribers.remove(queue)
+                return
+            if done:
+                return
+
+    def _broadcaster(self, flight):
+        async def on_token(token):
+            flight.tokens.append(token)
+            for queue in flight.subscribers:
+                queue.put_nowait(token)
+
+        return on_token
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def snapshot(self):
+        return {"in_flight": len(self._flights)}
+
+
+llm_flights = SingleFlight("llm")
+classifier_flights = SingleFlight("classifier")
@@ -0,0 +1,426 @@
+import io
+import os
+import csv
+import json
+import hashlib
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from db import usage_metadata_collection, usage_daily_collection
+from services.history import decode_cursor, encode_cursor
+from services.metrics import Counter
+from services.quotas import user_limiter
+
+logger = logging.getLogger(__name__)
+
+usage_events = Counter(
+    "usage_events_total", "Usage events by outcome: written, dropped, failed, repaired"
+)
+usage_flushes = Counter("usage_flushes_total", "Batches the usage recorder wrote")
+
+USAGE_QUEUE_SIZE = int(os.getenv("USAGE_QUEUE_SIZE", "10000"))
+USAGE_FLUSH_SIZE = int(os.getenv("USAGE_FLUSH_SIZE", "200"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_ENQUEUE_TIMEOUT = float(os.getenv("USAGE_ENQUEUE_TIMEOUT", "0.5"))
+USAGE_WRITE_RETRIES = int(os.getenv("USAGE_WRITE_RETRIES", "3"))
+USAGE_REPAIR_INTERVAL = float(os.getenv("USAGE_REPAIR_INTERVAL", "300"))
+# Unflagged events older than this were left behind by a failed flush
+USAGE_REPAIR_AGE = float(os.getenv("USAGE_REPAIR_AGE", "120"))
+USAGE_PAGE_SIZE = int(os.getenv("USAGE_PAGE_SIZE", "100"))
+USAGE_MAX_PAGE_SIZE = int(os.getenv("USAGE_MAX_PAGE_SIZE", "1000"))
+USAGE_EXPORT_BATCH_SIZE = int(os.getenv("USAGE_EXPORT_BATCH_SIZE", "500"))
+
+# Fields of a usage event that /usage can return, _id always comes back
+USAGE_FIELDS = [
+    "user_id",
+    "timestamp",
+    "model",
+    "prompt_token_count",
+    "candidates_token_count",
+    "cached",
+    "coalesced",
+]
+USAGE_EXPORT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# usage_daily holds one document per (user_id, model, date) with running
+# token totals, so the dashboard reads days x models documents instead of
+# every usage event. Events are written with rolled_up false and flagged
+# once their batch is in usage_daily; events a failed flush left unflagged
+# are folded in later by repair_usage_rollups().
+
+
+def usage_day(timestamp):
+    return timestamp.strftime("%Y-%m-%d")
+
+
+def rollup_key(event):
+    return event["user_id"], event["model"], usage_day(event["timestamp"])
+
+
+def rollup_update(
+    user_id,
+    model,
+    day,
+    prompt_token_count,
+    candidates_token_count,
+    requests=1,
+    batch_id=None,
+):
+    selector = {"user_id": user_id, "model": model, "date": day}
+    update = {
+        "$inc": {
+            "prompt_token_count": prompt_token_count,
+            "candidates_token_count": candidates_token_count,
+            "total_tokens": prompt_token_count + candidates_token_count,
+            "requests": requests,
+        }
+    }
+    if batch_id:
+        # A batch applied before no longer matches, so re-applying it after
+        # a lost reply or a crash doesn't count its events twice. The id
+        # stays until the batch's events are flagged, see mark_rolled_up().
+        selector["applied_batches"] = {"$ne": batch_id}
+        update["$push"] = {"applied_batches": batch_id}
+    return selector, update
+
+
+def build_usage_event(
+    user_id,
+    prompt_token_count,
+    candidates_token_count,
+    model,
+    cached=False,
+    coalesced=False,
+):
+    # _id is set here so a retried insert_many can't write the event twice
+    event = {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "timestamp": datetime.utcnow(),
+        "prompt_token_count": prompt_token_count,
+        "candidates_token_count": candidates_token_count,
+        "model": model,
+        "rolled_up": False,
+    }
+    if cached:
+        event["cached"] = True
+    if coalesced:
+        # Shared another user's in-flight call, which holds the tokens
+        event["coalesced"] = True
+    return event
+
+
+async def insert_usage_events(events):
+    try:
+        await usage_metadata_collection.insert_many(events, ordered=False)
+    except BulkWriteError as e:
+        # Duplicates come from an earlier attempt that did reach the server
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+
+async def apply_usage_rollups(events, batch_id):
+    totals = defaultdict(lambda: [0, 0, 0])
+    for event in events:
+        key = rollup_key(event)
+        totals[key][0] += event["prompt_token_count"]
+        totals[key][1] += event["candidates_token_count"]
+        totals[key][2] += 1
+    updates = [
+        UpdateOne(*rollup_update(*key, *counts, batch_id=batch_id), upsert=True)
+        for key, counts in totals.items()
+    ]
+    for attempt in range(2):
+        try:
+            await usage_daily_collection.bulk_write(updates, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            # The upsert hit an existing day document: either it already
+            # has this batch, or another worker created it just now. A
+            # second try tells them apart, the first case stays a no-op.
+            updates = [updates[error["index"]] for error in errors]
+
+
+async def mark_rolled_up(events, batch_id):
+    await usage_metadata_collection.update_many(
+        {"_id": {"$in": [event["_id"] for event in events]}},
+        {"$set": {"rolled_up": True}},
+    )
+    # Flagged events are never re-applied, so their batch id can go. One
+    # left behind by a failure here only takes up space.
+    await usage_daily_collection.bulk_write(
+        [
+            UpdateOne(
+                {"user_id": user_id, "model": model, "date": day},
+                {"$pull": {"applied_batches": batch_id}},
+            )
+            for user_id, model, day in {rollup_key(event) for event in events}
+        ],
+        ordered=False,
+    )
+
+
+async def repair_usage_rollups(max_batches=100):
+    # Re-applies whole batches under their own batch id, so a batch whose
+    # rollup did land and only missed the flag is not counted twice
+    cutoff = datetime.utcnow() - timedelta(seconds=USAGE_REPAIR_AGE)
+    pipeline = [
+        {"$match": {"rolled_up": False, "timestamp": {"$lt": cutoff}}},
+        {"$group": {"_id": "$batch_id"}},
+        {"$limit": max_batches},
+    ]
+    batch_ids = [
+        item["_id"]
+        async for item in await usage_metadata_collection.aggregate(pipeline)
+    ]
+    repaired = 0
+    for batch_id in batch_ids:
+        events = await usage_metadata_collection.find(
+            {"batch_id": batch_id, "rolled_up": False}
+        ).to_list()
+        if events:
+            await apply_usage_rollups(events, batch_id)
+            await mark_rolled_up(events, batch_id)
+            repaired += len(events)
+    return repaired
+
+
+# Buffers usage events in memory and writes them in batches, once flush_size
+# events are queued or flush_interval seconds have passed. A full queue makes
+# record() wait up to enqueue_timeout before the event is dropped and counted.
+class UsageRecorder:
+    def __init__(
+        self,
+        queue_size=USAGE_QUEUE_SIZE,
+        flush_size=USAGE_FLUSH_SIZE,
+        flush_interval=USAGE_FLUSH_INTERVAL,
+        enqueue_timeout=USAGE_ENQUEUE_TIMEOUT,
+        retries=USAGE_WRITE_RETRIES,
+    ):
+        self.queue_size = queue_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.retries = retries
+        self.queue = None
+        self._task = None
+        self._repair_task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._run())
+        if self._repair_task is None or self._repair_task.done():
+            self._repair_task = asyncio.create_task(self._repair())
+
+    async def _repair(self):
+        while True:
+            await asyncio.sleep(USAGE_REPAIR_INTERVAL)
+            try:
+                usage_events.inc(await repair_usage_rollups(), outcome="repaired")
+            except Exception:
+                logger.exception("Repairing usage rollups failed")
+
+    async def record(
+        self,
+        user_id,
+        prompt_token_count,
+        candidates_token_count,
+        model,
+        cached=False,
+        coalesced=False,
+    ):
+        self.start()
+        event = build_usage_event(
+            user_id,
+            prompt_token_count,
+            candidates_token_count,
+            model,
+            cached,
+            coalesced,
+        )
+        user_limiter.add_tokens(
+            user_id, prompt_token_count + candidates_token_count, event["_id"]
+        )
+        try:
+            await asyncio.wait_for(self.queue.put(event), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            usage_events.inc(outcome="dropped")
+            logger.warning("Usage queue full, dropped event for %s", user_id)
+            return None
+        return event
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.flush_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _flush(self, batch):
+        usage_flushes.inc()
+        # Kept across retries, so a rollup the server applied but whose reply
+        # was lost is not applied twice
+        batch_id = str(ObjectId())
+        for event in batch:
+            event["batch_id"] = batch_id
+        # Flagged only once the rollup is in, so a batch that runs out of
+        # retries is picked up by the repair instead of being lost
+        steps = [
+            ("insert_usage_events", lambda: insert_usage_events(batch)),
+            ("apply_usage_rollups", lambda: apply_usage_rollups(batch, batch_id)),
+            ("mark_rolled_up", lambda: mark_rolled_up(batch, batch_id)),
+        ]
+        for name, write in steps:
+            for attempt in range(1, self.retries + 1):
+                try:
+                    await write()
+                    break
+                except Exception:
+                    logger.exception(
+                        "%s failed (attempt %s/%s)",
+                        name,
+                        attempt,
+                        self.retries,
+                    )
+                    if attempt == self.retries:
+                        usage_events.inc(len(batch), outcome="failed")
+                        return
+                    await asyncio.sleep(0.2 * 2**attempt)
+        usage_events.inc(len(batch), outcome="written")
+
+    async def drain(self):
+        if self._task is None:
+            return
+        if not self._task.done():
+            await self.queue.join()
+            self._task.cancel()
+        if self._repair_task is not None:
+            self._repair_task.cancel()
+            self._repair_task = None
+        self._task = None
+        logger.info("Usage recorder drained")
+
+    def snapshot(self):
+        return {"queued": self.queue.qsize() if self.queue else 0}
+
+
+usage_recorder = UsageRecorder()
+
+
+async def backfill_usage_rollups(batch_size=500):
+    # Fold events written before rollups existed (no rolled_up field) into
+    # usage_daily. Each batch is keyed by its event ids, so a re-run after a
+    # crash between the rollup and the flag skips what was already counted.
+    legacy = {"rolled_up": {"$exists": False}}
+    backfilled = 0
+    while True:
+        events = await (
+            usage_metadata_collection.find(legacy)
+            .sort("_id", ASCENDING)
+            .limit(batch_size)
+            .to_list()
+        )
+        if not events:
+            return backfilled
+        digest = hashlib.sha256(b"".join(event["_id"].binary for event in events))
+        batch_id = f"backfill-{digest.hexdigest()[:24]}"
+        await apply_usage_rollups(events, batch_id)
+        await mark_rolled_up(events, batch_id)
+        backfilled += len(events)
+
+
+def usage_fields(fields=None):
+    if not fields:
+        return USAGE_FIELDS
+    unknown = [field for field in fields if field not in USAGE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown usage fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(fields))
+
+
+def find_usage_events(user_id, fields, cursor=None):
+    # Newest first, keyed on (timestamp, _id) so pages never skip or repeat
+    # events that share a timestamp
+    query = {"user_id": user_id}
+    if cursor:
+        timestamp, event_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": event_id}},
+        ]
+    # timestamp is needed for the next cursor even when not asked for
+    projection = {field: 1 for field in ["timestamp", *fields]}
+    return usage_metadata_collection.find(query, projection).sort(
+        [("timestamp", DESCENDING), ("_id", DESCENDING)]
+    )
+
+
+async def list_usage_events(user_id, cursor=None, limit=None, fields=None):
+    limit = min(max(limit or USAGE_PAGE_SIZE, 1), USAGE_MAX_PAGE_SIZE)
+    events = (
+        await find_usage_events(user_id, usage_fields(fields), cursor)
+        .limit(limit + 1)
+        .to_list()
+    )
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(events[-1], "timestamp")
+    return events, next_cursor
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+async def export_usage_events(
+    user_id, export_format, fields=None, cursor=None, batch_size=USAGE_EXPORT_BATCH_SIZE
+):
+    # Yields NDJSON or CSV text one cursor batch at a time, so only a batch
+    # of events is ever held in memory whatever the size of the export
+    columns = ["_id", *usage_fields(fields)]
+    buffer = io.StringIO()
+    writer = None
+    if export_format == "csv":
+        writer = csv.DictWriter(buffer, columns, extrasaction="ignore")
+        writer.writeheader()
+
+    rows = 0
+    events = find_usage_events(user_id, columns[1:], cursor).batch_size(batch_size)
+    async for event in events:
+        row = {key: export_value(value) for key, value in event.items()}
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False) + "\n")
+        rows += 1
+        if rows % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
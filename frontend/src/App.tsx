@@ -38,7 +38,7 @@ function App() {
       picture: user.picture,
     });
     const responseConversation = await getListConversations();
-    addChatList(responseConversation.data.reverse());
+    addChatList(responseConversation.data);
     if (path.startsWith(`/dashboard/chats`) || path.startsWith("/analyze")) {
       navigate(`${path}`);
     } else {
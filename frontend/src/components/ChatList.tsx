@@ -87,7 +87,7 @@ const DropdownMenu: React.FC<DropdownMenuProps> = ({
           navigate("/dashboard");
         }
         const responseConversation = await getListConversations();
-        addChatList(responseConversation.data.reverse());
+        addChatList(responseConversation.data);
         toast.success(t("delete_success"));
       }
     } catch (error) {
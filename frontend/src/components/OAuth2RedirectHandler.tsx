@@ -23,7 +23,7 @@ const OAuth2RedirectHandler = () => {
       picture: user.picture,
     });
     const responseConversation = await getListConversations();
-    addChatList(responseConversation.data.reverse());
+    addChatList(responseConversation.data);
     navigate("/dashboard");
     toast.success(t("login_success"));
   };
@@ -133,7 +133,7 @@ const ChatPage = () => {
   // Reset list conversations
   const updateListConversations = async () => {
     const responseConversation = await getListConversations();
-    addChatList(responseConversation.data.reverse());
+    addChatList(responseConversation.data);
   };
 
   const getTotalTokens = async () => {
@@ -145,11 +145,33 @@ const ChatPage = () => {
   const flatMessages = useMemo(() => {
     return flattenMessages(messages, (m) => m.type.includes("message"));
   }, [messages]);
+  // Streamed messages carry plain text as it arrives, the turn still ends
+  // with the usual JSON message which replaces them
+  const isStreamMessage = (m: IStep) => m.metadata?.message_type === "stream";
+  const streamingMessages = useMemo(() => {
+    let last = flatMessages.length - 1;
+    while (
+      last >= 0 &&
+      (flatMessages[last].name !== "Assistant" ||
+        isStreamMessage(flatMessages[last]))
+    ) {
+      last--;
+    }
+    return flatMessages
+      .slice(last + 1)
+      .filter(
+        (m) =>
+          isStreamMessage(m) &&
+          m.output &&
+          (chatId === "new" || m.metadata?.conversation_id === chatId)
+      );
+  }, [flatMessages, chatId]);
   useEffect(() => {
     if (!flatMessages || flatMessages.length === 0) return;
     if (flatMessages.length === prevMessagesLength) return;
     setPrevMessagesLength(flatMessages.length);
     const newMessage = flatMessages[flatMessages.length - 1];
+    if (isStreamMessage(newMessage)) return;
     getTotalTokens();
     if (
       //new chat
@@ -157,6 +179,13 @@ const ChatPage = () => {
       newMessage?.metadata?.conversation_id &&
       newMessage.name === "Assistant"
     ) {
+      if (newMessage.metadata.rejected) {
+        // Refused before the chat was created, there is nothing to open
+        setIsWaitingForResponse(false);
+        toast.error(JSON.parse(newMessage.output)[0].text);
+        navigate("/dashboard", { replace: true });
+        return;
+      }
       navigate(`/dashboard/chats/${newMessage.metadata.conversation_id}`, {
         replace: true,
       });
@@ -365,6 +394,20 @@ const ChatPage = () => {
               )}
             </div>
           ))}
+          {isWaitingForResponse &&
+            streamingMessages.map((message) => (
+              <div
+                key={message.id}
+                className="p-4 max-w-[80%] rounded-xl self-start text-gray-700 dark:text-gray-300 text-justify leading-[1.5]"
+              >
+                <Markdown
+                  remarkPlugins={[remarkMath]}
+                  rehypePlugins={[rehypeKatex]}
+                >
+                  {message.output}
+                </Markdown>
+              </div>
+            ))}
           {isWaitingForResponse && (
             <div className="self-start flex items-center gap-4">
               <img